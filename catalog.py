@@ -1,19 +1,37 @@
-from flask import Flask, jsonify, render_template, request, redirect, url_for
-from flask import flash, make_response
-from sqlalchemy import create_engine, asc
-from sqlalchemy.orm import sessionmaker, exc
+from flask import Flask, render_template, request, redirect, url_for
+from flask import flash, make_response, stream_with_context, Markup
+from sqlalchemy import asc, and_, or_, text, DateTime
+from sqlalchemy.orm import sessionmaker, scoped_session, selectinload, exc
+from sqlalchemy.orm import make_transient_to_detached
 from sqlalchemy.exc import SQLAlchemyError
+from jinja2 import FileSystemBytecodeCache
 from database_setup import Category, Base, Item, User
+from database_setup import getCatalogVersion, bumpCatalogVersion
+from database_setup import CATEGORIES_VERSION, createCatalogEngine
+from database_setup import postgresqlSearchVector
 from flask import session as login_session
-from oauth2client.client import flow_from_clientsecrets
+from oauth2client.client import OAuth2WebServerFlow
 from oauth2client.client import FlowExchangeError
-
+from catalogauth import TokenError, KeySet, PooledHttp, createHttpSession
+from catalogauth import verifyIdToken, TokenRevoker
+from catalogmetrics import Metrics, instrumentApp, instrumentEngine
+from catalogmetrics import logSlowQueries
+from catalogserialize import httpDate, plainItem, jsonFormat
+from catalogserialize import chooseSerializer, serializedResponse
+from catalogcompress import chooseEncoding, compressedBody, compressResponse
+from catalogcompress import setContentEncoding, compress_min_bytes
+from catalogstatic import fingerprintStatic
+
+import collections
 import contextlib
-import httplib2
+import hashlib
+import itertools
 import json
+import os
 import random
 import string
-import requests
+import threading
+import time
 
 '''
 Create an instance of the Flask class for our web app.
@@ -24,19 +42,71 @@ app = Flask(__name__)
 
 
 '''
-Google Auth2 Credentials
+Compiled templates are kept on disk in CATALOG_TEMPLATE_CACHE_DIR, by default
+a directory under the system temporary directory, so that a new worker loads
+them instead of compiling them again.  Set CATALOG_PREWARM_TEMPLATES=1 to
+compile every template when the application starts instead of on first use.
+'''
+template_cache_dir = os.environ.get('CATALOG_TEMPLATE_CACHE_DIR')
+prewarm_templates = os.environ.get('CATALOG_PREWARM_TEMPLATES', '0') == '1'
+
+
+def prewarmTemplates():
+    '''
+    Load every template of the application and report how long it took
+    '''
+    start = time.time()
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    print "Loaded %d templates in %.1f ms" \
+        % (len(names), (time.time() - start) * 1000)
+
+
+'''
+Static files are served under names with a hash of their content, cached by
+browsers for CATALOG_STATIC_MAX_AGE seconds; set it to 0 to serve them under
+their plain names only.
+'''
+static_max_age = int(os.environ.get('CATALOG_STATIC_MAX_AGE', 365 * 24 * 3600))
+
+
+'''
+Google Auth2 Credentials, read from client_secrets.json by createApp()
 '''
-CLIENT_ID = json.loads(
-    open('client_secrets.json', 'r').read())['web']['client_id']
+client_secrets = None
+CLIENT_ID = None
 APPLICATION_NAME = "Item Catalog"
 
 
 '''
-Bind the engine to the metadata of the Base class so that
-the declaratives can be accessed through a DBSession instance
+Calls to Google share CATALOG_HTTP_POOL_SIZE keep-alive connections and give
+up after CATALOG_HTTP_TIMEOUT seconds.  ID tokens are verified against the
+signing keys published at CATALOG_OAUTH_CERTS_URL, by default the
+auth_provider_x509_cert_url of the client secrets.
+
+Access tokens are revoked at logout by CATALOG_REVOKE_WORKERS background
+threads.  At most CATALOG_REVOKE_QUEUE_SIZE tokens wait to be revoked, and
+each is retried CATALOG_REVOKE_RETRIES times while Google is unreachable.
+'''
+http_timeout = float(os.environ.get('CATALOG_HTTP_TIMEOUT', 10))
+http_session = None
+google_keys = None
+token_revoker = None
+
+
+'''
+The engine of the database, created by createApp().  The database URL and
+connection pool are configured by the environment variables described in
+database_setup.createCatalogEngine().
+
+Read-only pages can be served from a replica of the database, set with the
+CATALOG_READ_DATABASE_URL environment variable, while every write and every
+other route uses the primary database.  Without a replica both are the same
+engine.
 '''
-dburl = 'sqlite:///catalogwithusers.db'
-engine = create_engine(dburl)
+engine = None
+read_engine = None
 
 
 '''
@@ -46,9 +116,315 @@ session object.  Any change made against the objects in the session won't
 be persistent into the database until you call session.commit().
 If you're not happy about the changes, you can revert all of them back to
 the last commit by calling session.rollback().
+
+The session is a scoped_session: every thread serving a request gets its own
+DBSession() on first use, and shutdownSession() below closes it at the end of
+the request so no identity-map state leaks from one user to the next.
+DBSession is bound to the engine by createApp().
+'''
+DBSession = sessionmaker()
+session = scoped_session(DBSession)
+
+
+'''
+Count every request and the SQL queries it runs, for the /metrics endpoint
+'''
+metrics = Metrics()
+instrumentApp(app, metrics)
+
+
+'''
+Queries slower than CATALOG_SLOW_QUERY_MS milliseconds are logged with their
+query plan to the rotating log file CATALOG_SLOW_QUERY_LOG; set the
+threshold to 0 to turn the log off.
+'''
+slow_query_ms = int(os.environ.get('CATALOG_SLOW_QUERY_MS', 200))
+
+create_app_lock = threading.Lock()
+
+
+def createApp():
+    '''
+    Set up the application in the process that serves it and return it:
+    read the session signing key from CATALOG_SECRET_KEY, create the
+    database engines and bind DBSession to them, read the OAuth client
+    secrets, and prepare the templates and static files.  Nothing
+    connects to the database or to Google until a request needs it.  Run
+    the server on createApp() so that every worker process sets itself up,
+    e.g. gunicorn 'catalog:createApp()'; the database schema is created by
+    database_setup.py.
+    '''
+    global engine, read_engine, client_secrets, CLIENT_ID
+    global http_session, google_keys, token_revoker
+
+    with create_app_lock:
+        if engine is not None:
+            return app
+
+        # login sessions are signed with the secret key
+        app.secret_key = os.environ.get('CATALOG_SECRET_KEY') \
+            or app.secret_key
+        if not app.secret_key:
+            raise RuntimeError(
+                'Set CATALOG_SECRET_KEY to the key signing login sessions')
+
+        # templates
+        if template_cache_dir and not os.path.isdir(template_cache_dir):
+            os.makedirs(template_cache_dir)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
+            template_cache_dir or None)
+        if prewarm_templates:
+            prewarmTemplates()
+
+        # static files
+        if static_max_age > 0:
+            fingerprintStatic(app, static_max_age)
+
+        # Google Sign-In
+        client_secrets = json.loads(
+            open('client_secrets.json', 'r').read())['web']
+        CLIENT_ID = client_secrets['client_id']
+        http_session = createHttpSession(
+            int(os.environ.get('CATALOG_HTTP_POOL_SIZE', 10)))
+        google_keys = KeySet(
+            os.environ.get(
+                'CATALOG_OAUTH_CERTS_URL',
+                client_secrets.get(
+                    'auth_provider_x509_cert_url',
+                    'https://www.googleapis.com/oauth2/v1/certs')),
+            http_session, http_timeout)
+        token_revoker = TokenRevoker(
+            client_secrets.get(
+                'revoke_uri', 'https://accounts.google.com/o/oauth2/revoke'),
+            http_session, http_timeout,
+            workers=int(os.environ.get('CATALOG_REVOKE_WORKERS', 2)),
+            queue_size=int(os.environ.get('CATALOG_REVOKE_QUEUE_SIZE', 1000)),
+            retries=int(os.environ.get('CATALOG_REVOKE_RETRIES', 3)))
+
+        # database
+        primary = createCatalogEngine()
+        read_dburl = os.environ.get('CATALOG_READ_DATABASE_URL')
+        read_engine = createCatalogEngine(read_dburl) if read_dburl \
+            else primary
+        DBSession.configure(bind=primary)
+        for each in set([primary, read_engine]):
+            instrumentEngine(each)
+        if slow_query_ms > 0:
+            logSlowQueries(
+                set([primary, read_engine]), slow_query_ms / 1000.0,
+                os.environ.get('CATALOG_SLOW_QUERY_LOG', 'slow_queries.log'))
+
+        # set last, as it marks the application as set up
+        engine = primary
+        return app
+
+
+@app.before_first_request
+def setUpApp():
+    '''
+    Set up the application on its first request if the server was given the
+    app instead of createApp()
+    '''
+    createApp()
+
+
+@app.teardown_appcontext
+def shutdownSession(exception=None):
+    '''
+    Finish the request's database session and return its connection to the
+    pool: commit any pending work, or roll it back if the request failed
+    '''
+    try:
+        if exception is None:
+            session.commit()
+        else:
+            session.rollback()
+    except SQLAlchemyError:
+        session.rollback()
+    finally:
+        session.remove()
+
+
 '''
-DBSession = sessionmaker(bind=engine)
-session = DBSession()
+The GET requests of these routes only read the catalog, and are served from
+the replica when there is one
+'''
+read_endpoints = set([
+    'showCatalog', 'showCategory', 'showItem', 'showItemJson',
+    'showCategoryJson', 'showCatalogJson', 'searchCatalog',
+    'searchCatalogJson'])
+
+
+@app.before_request
+def chooseReadEngine():
+    '''
+    Bind the session of a read-only request to the replica, unless the user
+    made a change the replica has not caught up with yet
+    '''
+    if read_engine is engine or request.method not in ('GET', 'HEAD') \
+            or request.endpoint not in read_endpoints:
+        return
+    session.bind = read_engine
+
+    # read your own writes: a user who changed the catalog keeps reading
+    # from the primary until the replica reaches the version they wrote
+    written = login_session.get('catalog_version')
+    if written is not None:
+        if getCatalogVersion(session) < written:
+            session.close()
+            session.bind = engine
+        else:
+            del login_session['catalog_version']
+
+
+@app.after_request
+def rememberCatalogVersion(response):
+    '''
+    Remember the catalog version the user's write moved the primary to
+    '''
+    if read_engine is not engine \
+            and request.method not in ('GET', 'HEAD') \
+            and response.status_code < 400:
+        login_session['catalog_version'] = getCatalogVersion(session)
+    return response
+
+
+@app.after_request
+def compressCatalogResponse(response):
+    '''
+    Compress the response if the client accepts it
+    '''
+    return compressResponse(response)
+
+
+class FragmentCache(object):
+    '''
+    Rendered HTML fragments kept in memory, each tagged with the version of
+    the data it was rendered from.  Fragments larger than [max_bytes] are
+    not kept, and the whole cache is emptied before it would grow past it.
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.fragments = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        '''
+        Return the value cached for [key] at [version], or None
+        '''
+        with self.lock:
+            entry = self.fragments.get(key)
+            if entry is not None and entry[0] == version:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, key, version, html, value):
+        '''
+        Cache [value], which includes the rendered [html], for [key] at
+        [version]
+        '''
+        size = len(html)
+        with self.lock:
+            old = self.fragments.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            if size > self.max_bytes:
+                return
+            if self.size + size > self.max_bytes:
+                self.fragments.clear()
+                self.size = 0
+            self.fragments[key] = (version, value, size)
+            self.size += size
+
+
+'''
+The categories sidebar is the same for every visitor, so it is rendered
+once per version of the category list.  CATALOG_FRAGMENT_CACHE_BYTES bounds
+the memory used by cached fragments.
+'''
+fragment_cache = FragmentCache(
+    int(os.environ.get('CATALOG_FRAGMENT_CACHE_BYTES', 1024 * 1024)))
+
+
+def renderCategoriesSidebar():
+    '''
+    Return the rendered categories sidebar and the number of categories
+    '''
+    version = getCatalogVersion(session, CATEGORIES_VERSION)
+    cached = fragment_cache.get('categories', version)
+    if cached is not None:
+        return cached
+
+    # get categories from database ordered by name
+    categories = session.query(Category).filter_by(deleted=False).order_by(
+        asc(Category.name)).all()
+    sidebar = Markup(
+        render_template('categories.html', categories=categories))
+    fragment_cache.put(
+        'categories', version, sidebar, (sidebar, len(categories)))
+    return sidebar, len(categories)
+
+
+'''
+Deleting a category with more than CATALOG_PURGE_THRESHOLD items hides it at
+once and leaves its items to a background thread, which removes them
+CATALOG_PURGE_BATCH_SIZE at a time so that no transaction holds the
+database for long.
+'''
+purge_threshold = int(os.environ.get('CATALOG_PURGE_THRESHOLD', 10000))
+purge_batch_size = int(os.environ.get('CATALOG_PURGE_BATCH_SIZE', 1000))
+
+
+def purgeCategory(category_id):
+    '''
+    Delete the Items of a deleted Category in batches, then the Category
+    '''
+    purge_session = DBSession()
+    try:
+        while True:
+            ids = [id for id, in purge_session.query(Item.id).filter_by(
+                category_id=category_id).limit(purge_batch_size)]
+            if not ids:
+                break
+            purge_session.query(Item).filter(Item.id.in_(ids)).delete(
+                synchronize_session=False)
+            purge_session.commit()
+
+        # along with any item added while the category was being purged
+        purge_session.query(Item).filter_by(category_id=category_id).delete(
+            synchronize_session=False)
+        purge_session.query(Category).filter_by(
+            id=category_id, deleted=True).delete(synchronize_session=False)
+        purge_session.commit()
+    except SQLAlchemyError as e:
+        purge_session.rollback()
+        print "Purge of category %d failed: %s" % (category_id, e)
+    finally:
+        purge_session.close()
+
+
+def startCategoryPurge(category_id):
+    '''
+    Purge a deleted Category on a background thread
+    '''
+    thread = threading.Thread(target=purgeCategory, args=(category_id,))
+    thread.daemon = True
+    thread.start()
+
+
+@app.before_first_request
+def resumeCategoryPurges():
+    '''
+    Restart the purge of Categories deleted before the last shutdown
+    '''
+    for id, in session.query(Category.id).filter_by(deleted=True):
+        startCategoryPurge(id)
 
 
 @app.route('/catalog/category/new', methods=['GET', 'POST'])
@@ -75,6 +451,8 @@ def createCategory():
 
             # add and commit the Category object to the database
             session.add(category)
+            bumpCatalogVersion(session)
+            bumpCatalogVersion(session, CATEGORIES_VERSION)
             session.commit()
 
             # added flash message
@@ -121,7 +499,8 @@ def editCategory(category_name, category_id):
         return redirect('/login')
 
     # get the category data to edit from the database
-    category = session.query(Category).filter_by(id=category_id).one()
+    category = session.query(Category).filter_by(
+        id=category_id, deleted=False).one()
 
     # if user is not the creator of this category, redirect to catalog page
     if category.user_id != login_session['user_id']:
@@ -139,6 +518,8 @@ def editCategory(category_name, category_id):
 
         # add the Category object to the database and commit it
         session.add(category)
+        bumpCatalogVersion(session)
+        bumpCatalogVersion(session, CATEGORIES_VERSION)
         session.commit()
 
         # add a flash message
@@ -172,7 +553,8 @@ def deleteCategory(category_name, category_id):
         return redirect('/login')
 
     # get the category data to edit from the database
-    category = session.query(Category).filter_by(id=category_id).one()
+    category = session.query(Category).filter_by(
+        id=category_id, deleted=False).one()
 
     # if user is not the creator of this category, redirect to catalog page
     if category.user_id != login_session['user_id']:
@@ -183,16 +565,35 @@ def deleteCategory(category_name, category_id):
 
     # if this is a POST request
     if request.method == 'POST':
-        # first delete all the items in the category
-        items = session.query(Item).filter_by(category_id=category.id).all()
-        for item in items:
-            session.delete(item)
+        # get the count of items in the category
+        rows = session.query(Item).filter_by(category_id=category.id).count()
+
+        # hide a large category now and purge its items in the background
+        if rows > purge_threshold:
+            category.deleted = True
+            bumpCatalogVersion(session)
+            bumpCatalogVersion(session, CATEGORIES_VERSION)
             session.commit()
+            startCategoryPurge(category.id)
+
+            # add flash message
+            flash(
+                "Catalog Category '%s' Successfully Deleted, its %d Items"
+                " are being removed" % (category.name, rows))
+
+            # redirect page to main Catalog page
+            return redirect(url_for('showCatalog'))
+
+        # delete all the items in the category with a single statement
+        session.query(Item).filter_by(category_id=category.id).delete(
+            synchronize_session=False)
 
         # delete the category itself
         session.delete(category)
 
         # commit actions in the database
+        bumpCatalogVersion(session)
+        bumpCatalogVersion(session, CATEGORIES_VERSION)
         session.commit()
 
         # add flash message
@@ -228,7 +629,8 @@ def addItemToCategory(category_name, category_id):
         return redirect('/login')
 
     # get the category creator
-    category = session.query(Category).filter_by(id=category_id).one()
+    category = session.query(Category).filter_by(
+        id=category_id, deleted=False).one()
 
     # if logged-in user is not the creator of this category,
     # redirect to catalog page
@@ -242,7 +644,7 @@ def addItemToCategory(category_name, category_id):
     item = Item(user_id=login_session['user_id'])
 
     # get all the categories from database
-    categories = session.query(Category).all()
+    categories = session.query(Category).filter_by(deleted=False).all()
 
     # if this is a POST request
     if request.method == 'POST':
@@ -260,9 +662,10 @@ def addItemToCategory(category_name, category_id):
             # assign the category id to the Item object
             item.category_id = request.form.get('categories')
 
-            # query the database for the creator of this category
+            # query the database for the creator of this category, which
+            # must not be on its way out
             category_user = session.query(Category).filter_by(
-                id=item.category_id).one().user_id
+                id=item.category_id, deleted=False).one().user_id
 
         # if user is not the creator of this category, redirect to catalog page
         if category_user != login_session['user_id']:
@@ -273,8 +676,13 @@ def addItemToCategory(category_name, category_id):
         else:
             # add and commit Item to the database
             session.add(item)
+            bumpCatalogVersion(session)
             session.commit()
 
+            # keep the in-memory list of latest items and counts current
+            recentItemSaved(item, True)
+            categoryItemsChanged((item.category_id, 1))
+
             # add a flash message
             flash("Catalog Item '%s' Successfully Added" % item.name)
 
@@ -308,7 +716,7 @@ def createItem():
         return redirect('/login')
 
     # get all the categories from database to populate the newitem.html page
-    categories = session.query(Category).all()
+    categories = session.query(Category).filter_by(deleted=False).all()
 
     # create an Item instance
     item = Item(user_id=login_session['user_id'])
@@ -327,10 +735,10 @@ def createItem():
         # query the database for category name and user who created it
         if request.form.get('categories'):
             category_id = request.form.get('categories')
-            category_name = session.query(Category).filter_by(
-                id=category_id).one().name
-            category_user = session.query(Category).filter_by(
-                id=category_id).one().user_id
+            selected = session.query(Category).filter_by(
+                id=category_id, deleted=False).one()
+            category_name = selected.name
+            category_user = selected.user_id
 
         # if user is not the creator of this category, redirect to catalog page
         if category_user != login_session['user_id']:
@@ -345,8 +753,13 @@ def createItem():
 
             # add and commit Item to database
             session.add(item)
+            bumpCatalogVersion(session)
             session.commit()
 
+            # keep the in-memory list of latest items and counts current
+            recentItemSaved(item, True)
+            categoryItemsChanged((item.category_id, 1))
+
             # add flash message
             flash("Catalog Item '%s' Successfully Added" % item.name)
 
@@ -388,7 +801,7 @@ def editItem(category_name, item_name, item_id):
         return redirect(url_for('showCatalog'))
 
     # get all the Categories from database to populate the HTML form
-    categories = session.query(Category).all()
+    categories = session.query(Category).filter_by(deleted=False).all()
 
     # if this is a POST request
     if request.method == 'POST':
@@ -408,10 +821,10 @@ def editItem(category_name, item_name, item_id):
             category_id = request.form.get('categories')
 
             # query the database for the name and creator of category
-            category_name = session.query(Category).filter_by(
-                id=category_id).one().name
-            category_user = session.query(Category).filter_by(
-                id=category_id).one().user_id
+            selected = session.query(Category).filter_by(
+                id=category_id, deleted=False).one()
+            category_name = selected.name
+            category_user = selected.user_id
 
         print "I am %d: Category %s created by %d" \
             % (login_session['user_id'], category_name, category_user)
@@ -425,12 +838,19 @@ def editItem(category_name, item_name, item_id):
             return redirect(url_for('showCatalog'))
         else:
             # assign category_id to item
+            previous_category_id = item.category_id
             item.category_id = category_id
 
             # add and commit Item to database
             session.add(item)
+            bumpCatalogVersion(session)
             session.commit()
 
+            # keep the in-memory list of latest items and counts current
+            recentItemSaved(item, False)
+            categoryItemsChanged(
+                (previous_category_id, -1), (item.category_id, 1))
+
             # add flash message
             flash("Catalog Item '%s' Successfully Edited" % item.name)
 
@@ -489,9 +909,15 @@ def deleteItem(category_name, item_name, item_id):
     # if this is a POST request
     if request.method == 'POST':
         # delete and commit Item in database
+        category_id = item.category_id
         session.delete(item)
+        bumpCatalogVersion(session)
         session.commit()
 
+        # keep the in-memory list of latest items and counts current
+        recentItemDeleted(item_id)
+        categoryItemsChanged((category_id, -1))
+
         # add flash message
         flash("Catalog Item '%s' Successfully deleted" % item.name)
 
@@ -540,6 +966,37 @@ def showItem(category_name, item_name, item_id):
         if 'username' in login_session else "")
 
 
+'''
+Category item listings and the JSON endpoints are paged by id: a page holds
+the rows with ids greater than ?after=<id>, at most ?limit=N of them.
+CATALOG_PAGE_SIZE is the default page size and CATALOG_MAX_PAGE_SIZE the
+largest one a client may ask for.
+'''
+page_size = int(os.environ.get('CATALOG_PAGE_SIZE', 100))
+max_page_size = int(os.environ.get('CATALOG_MAX_PAGE_SIZE', 1000))
+
+
+def getPageArgs():
+    '''
+    Return the (after, limit) paging arguments of the current request
+    '''
+    after = request.args.get('after', 0, type=int)
+    limit = request.args.get('limit', page_size, type=int)
+    return max(after, 0), min(max(limit, 1), max_page_size)
+
+
+def keysetPage(query, key, after, limit):
+    '''
+    Return the rows of [query] whose [key] is greater than [after], at most
+    [limit] of them in [key] order, and the [key] to continue from or None
+    on the last page
+    '''
+    rows = query.filter(key > after).order_by(key).limit(limit + 1).all()
+    if len(rows) > limit:
+        return rows[:limit], getattr(rows[limit - 1], key.key)
+    return rows, None
+
+
 @app.route(
     '/catalog/<string:category_name>/<string:item_name>/<int:item_id>/JSON')
 def showItemJson(category_name, item_name, item_id):
@@ -549,32 +1006,256 @@ def showItemJson(category_name, item_name, item_id):
     # get Item based on its id
     item = session.query(Item).filter_by(id=item_id).one()
 
-    return jsonify(item.serialize)
+    return serializedResponse(plainItem(item))
+
+
+@app.route('/catalog/<string:category_name>/<int:category_id>/items/JSON')
+def showCategoryJson(category_name, category_id):
+    '''
+    Show one page of the Items of a Category in JSON format
+    '''
+    after, limit = getPageArgs()
+
+    # a deleted category has no items to show, even while they are purged
+    if session.query(Category.id).filter_by(
+            id=category_id, deleted=False).first() is None:
+        response = make_response(json.dumps('Category not found.'), 404)
+        response.headers['Content-Type'] = 'application/json'
+        return response
+
+    # get a page of catalog items for this category
+    items, next_after = keysetPage(
+        session.query(Item).filter_by(category_id=category_id),
+        Item.id, after, limit)
+
+    return serializedResponse({
+        'items': [plainItem(i) for i in items],
+        'next': url_for(
+            'showCategoryJson', category_name=category_name,
+            category_id=category_id, after=next_after, limit=limit)
+        if next_after is not None else None})
+
+
+class RecentItems(object):
+    '''
+    A bounded, newest first list of the latest Items for the home page, kept
+    up to date by the item write routes of this process.  The list is tagged
+    with the catalog version it reflects; a change made by another process
+    moves the version on, and the list is then reloaded from the database.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.version = None
+        self.items = []
+
+        # True when the list holds every Item in the catalog
+        self.complete = False
+
+    def get(self, version, limit):
+        '''
+        Return the latest [limit] Items, or None if the list cannot tell
+        '''
+        with self.lock:
+            if self.version != version:
+                return None
+            if limit > len(self.items) and not self.complete:
+                return None
+            return [dict(item) for item in self.items[:limit]]
+
+    def load(self, version, items, complete):
+        '''
+        Replace the list with [items] read from the database at [version]
+        '''
+        with self.lock:
+            self.version = version
+            self.items = [dict(item) for item in items[:self.size]]
+            self.complete = complete and len(items) <= self.size
+
+    def update(self, version, change):
+        '''
+        Apply [change] to the list for the write that moved the catalog to
+        [version], or drop the list if it missed an earlier write
+        '''
+        with self.lock:
+            if self.version is not None and self.version + 1 == version:
+                change(self.items)
+                if len(self.items) > self.size:
+                    del self.items[self.size:]
+                    self.complete = False
+                self.version = version
+            else:
+                self.version = None
+
+
+'''
+Set CATALOG_RECENT_ITEMS to the number of latest Items to keep in memory for
+the home page; 0, the default, always reads them from the database.
+'''
+recent_items_size = int(os.environ.get('CATALOG_RECENT_ITEMS', 0))
+recent_items = RecentItems(recent_items_size) if recent_items_size else None
+
+
+def recentItemSaved(item, created):
+    '''
+    Record a newly [created] or edited Item in the recent items list
+    '''
+    if recent_items is None:
+        return
+    entry = {
+        'id': item.id, 'name': item.name, 'category': item.category.name}
+
+    def change(items):
+        for index, recent in enumerate(items):
+            if recent['id'] == entry['id']:
+                items[index] = entry
+                return
+
+        # an edited Item missing from the list is older than all of it
+        if created:
+            items.insert(0, entry)
+
+    recent_items.update(getCatalogVersion(session), change)
+
+
+def recentItemDeleted(item_id):
+    '''
+    Remove a deleted Item from the recent items list
+    '''
+    if recent_items is None:
+        return
+
+    def change(items):
+        items[:] = [item for item in items if item['id'] != item_id]
+
+    recent_items.update(getCatalogVersion(session), change)
 
 
 def showLatestItems(limit):
     '''
     Show only the latest [limit] Items
     '''
-    # get a limited number of items from database that are created last
-    items = session.query(Item).order_by(Item.created.desc()).limit(limit)
+    # use the in-memory list of latest items when it is current
+    if recent_items is not None:
+        version = getCatalogVersion(session)
+        latest_items = recent_items.get(version, limit)
+        if latest_items is not None:
+            return latest_items
+
+    # get the id, name and category name of the items that are created
+    # last in a single query, enough of them to refill the in-memory list
+    fetch = max(limit, recent_items_size)
+    rows = session.query(Item.id, Item.name, Category.name).join(
+        Category, Item.category_id == Category.id).filter_by(
+        deleted=False).order_by(
+        Item.created.desc()).limit(fetch).all()
 
     # create a dictionary list
-    latest_items = []
+    latest_items = [
+        {'id': id, 'name': name, 'category': category}
+        for id, name, category in rows]
 
-    # traverse each item in items
-    for item in items:
-        # showItem(item.id)
+    if recent_items is not None:
+        recent_items.load(version, latest_items, len(rows) < fetch)
 
-        # query the database for the category associated with item
-        category = session.query(Category).filter_by(id=item.category_id).one()
+    # return the dictionary list
+    return latest_items[:limit]
 
-        # append a dictionary to list
-        latest_items.append(
-            {'id': item.id, 'name': item.name, 'category': category.name})
 
-    # return the dictionary list
-    return latest_items
+class CategoryItemCounts(object):
+    '''
+    The item counts of the most recently shown Categories, at most [size] of
+    them, kept up to date by the item write routes of this process.  The
+    counts are tagged with the catalog version they reflect; a change made
+    by another process moves the version on, and they are counted again.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.version = None
+        self.counts = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, version, category_id):
+        '''
+        Return the item count of [category_id] at [version], or None
+        '''
+        with self.lock:
+            rows = self.counts.pop(category_id, None) \
+                if self.version == version else None
+            if rows is None:
+                self.misses += 1
+                return None
+            # move the entry to the most recently used end
+            self.counts[category_id] = rows
+            self.hits += 1
+            return rows
+
+    def put(self, version, category_id, rows):
+        '''
+        Cache the item count [rows] of [category_id] read at [version],
+        dropping the least recently used count when the cache is full
+        '''
+        with self.lock:
+            if self.version is not None and version < self.version:
+                return
+            if self.version != version:
+                self.counts.clear()
+                self.version = version
+            self.counts.pop(category_id, None)
+            self.counts[category_id] = rows
+            while len(self.counts) > self.size:
+                self.counts.popitem(last=False)
+
+    def update(self, version, changes):
+        '''
+        Add the item count [changes], a list of (category_id, change)
+        pairs, for the write that moved the catalog to [version], or drop
+        the counts if they missed an earlier write
+        '''
+        with self.lock:
+            if self.version is not None and self.version + 1 == version:
+                for category_id, change in changes:
+                    if category_id in self.counts:
+                        self.counts[category_id] += change
+                self.version = version
+            else:
+                self.counts.clear()
+                self.version = None
+
+
+'''
+CATALOG_ITEM_COUNT_CACHE_SIZE bounds the number of category item counts kept
+in memory
+'''
+category_item_counts = CategoryItemCounts(
+    int(os.environ.get('CATALOG_ITEM_COUNT_CACHE_SIZE', 10000)))
+
+
+def countCategoryItems(category_id):
+    '''
+    Return the number of items of the category [category_id], counted once
+    rather than on every page
+    '''
+    version = getCatalogVersion(session)
+    rows = category_item_counts.get(version, category_id)
+    if rows is None:
+        rows = session.query(Item).filter_by(category_id=category_id).count()
+        category_item_counts.put(version, category_id, rows)
+    return rows
+
+
+def categoryItemsChanged(*changes):
+    '''
+    Record the item count [changes], (category_id, change) pairs, of the
+    write just committed
+    '''
+    category_item_counts.update(getCatalogVersion(session), [
+        (int(category_id), change) for category_id, change in changes
+        if category_id is not None])
 
 
 @app.route('/catalog/<string:category_name>/<int:category_id>/items')
@@ -584,24 +1265,31 @@ def showCategory(category_name, category_id):
     No Login required
     '''
 
-    # get categories from database ordered by name
-    categories = session.query(Category).order_by(asc(Category.name))
+    # get the rendered categories sidebar
+    sidebar, _ = renderCategoriesSidebar()
 
     # get category by its id
-    category = session.query(Category).filter_by(id=category_id).one()
+    category = session.query(Category).filter_by(
+        id=category_id, deleted=False).one()
 
-    # get catalog items for this category
-    items = session.query(Item).filter_by(category_id=category_id).all()
+    # get a page of catalog items for this category
+    after, limit = getPageArgs()
+    items, next_after = keysetPage(
+        session.query(Item).filter_by(category_id=category_id),
+        Item.id, after, limit)
 
     # get the count of items
-    rows = session.query(Item).filter_by(category_id=category_id).count()
+    rows = countCategoryItems(category_id)
 
     # display the catalogitem.html page
     return render_template(
         'catalogitem.html',
-        categories=categories,
+        sidebar=sidebar,
         items=items,
         rows=rows,
+        after=after,
+        next_after=next_after,
+        limit=limit,
         category=category,
         user_id=login_session['user_id']
         if 'user_id' in login_session else "",
@@ -609,6 +1297,92 @@ def showCategory(category_name, category_id):
         if 'username' in login_session else "")
 
 
+def searchItems(terms, page, limit):
+    '''
+    Return one page of the Items matching the search [terms], best matches
+    first, and whether there is a next page
+    '''
+    if not terms.split():
+        return [], False
+
+    if engine.dialect.name == 'postgresql':
+        # rank the items whose text search vector matches every word
+        search = '''
+           FROM item
+           JOIN category ON category.id = item.category_id
+           WHERE %(vector)s @@ plainto_tsquery('english', :query)
+             AND NOT category.deleted
+           ORDER BY ts_rank(%(vector)s,
+                            plainto_tsquery('english', :query)) DESC,
+                    item.id''' % {'vector': postgresqlSearchVector('item')}
+        query = terms
+    else:
+        # quote every word so that the search terms are never read as FTS5
+        # query syntax, and match words starting with each term
+        search = '''
+           FROM item_fts
+           JOIN item ON item.id = item_fts.rowid
+           JOIN category ON category.id = item.category_id
+           WHERE item_fts MATCH :query AND NOT category.deleted
+           ORDER BY bm25(item_fts), item.id'''
+        query = ' '.join(
+            '"%s"*' % word.replace('"', '""') for word in terms.split())
+
+    rows = session.execute(text(
+        '''SELECT item.id, item.name, item.description, item.category_id,
+                  item.user_id, item.created, category.name'''
+        + search + '''
+           LIMIT :limit OFFSET :offset''').columns(created=DateTime),
+        {'query': query, 'limit': limit + 1, 'offset': (page - 1) * limit}
+    ).fetchall()
+
+    items = [{
+        'id': id, 'name': name, 'description': description,
+        'category_id': category_id, 'user_id': user_id, 'created': created,
+        'category': category}
+        for id, name, description, category_id, user_id, created, category
+        in rows[:limit]]
+    return items, len(rows) > limit
+
+
+@app.route('/catalog/search')
+@app.route('/catalog/search/JSON', endpoint='searchCatalogJson')
+def searchCatalog():
+    '''
+    Search Item names and descriptions, as an HTML page or in JSON format
+    '''
+    terms = request.args.get('q', '')
+    page = max(request.args.get('page', 1, type=int), 1)
+    _, limit = getPageArgs()
+
+    # get a page of the best matching items
+    items, more = searchItems(terms, page, limit)
+
+    if request.endpoint == 'searchCatalogJson':
+        for item in items:
+            item['created'] = httpDate(item['created'])
+        return serializedResponse({
+            'items': items,
+            'next': url_for(
+                'searchCatalogJson', q=terms, page=page + 1, limit=limit)
+            if more else None})
+
+    # get the rendered categories sidebar
+    sidebar, _ = renderCategoriesSidebar()
+
+    # display the search.html page
+    return render_template(
+        'search.html',
+        sidebar=sidebar,
+        terms=terms,
+        items=items,
+        page=page,
+        more=more,
+        limit=limit,
+        username=login_session['username']
+        if 'username' in login_session else "")
+
+
 @app.route('/')
 @app.route('/catalog')
 @app.route('/catalog/')
@@ -616,11 +1390,8 @@ def showCatalog():
     '''
     Show content of Catalog Categories and their corresponding items
     '''
-    # get categories from database ordered by name
-    categories = session.query(Category).order_by(asc(Category.name))
-
-    # get count of categories
-    rows = session.query(Category).count()
+    # get the rendered categories sidebar and the count of categories
+    sidebar, rows = renderCategoriesSidebar()
 
     # get the latest items based on the number of existing categories
     latest_items = showLatestItems(rows)
@@ -628,20 +1399,299 @@ def showCatalog():
     # display the catalog.html page
     return render_template(
         'catalog.html',
-        categories=categories,
+        sidebar=sidebar,
         latest_items=latest_items,
         username=login_session['username']
         if 'username' in login_session else "")
 
 
+'''
+/catalog.json can be streamed instead of built in memory, either for every
+request by setting CATALOG_JSON_STREAM=1 in the environment, or for a single
+request by adding ?stream=1 to the URL.  Rows are fetched
+CATALOG_JSON_BATCH_SIZE at a time.
+'''
+stream_catalog_json = os.environ.get('CATALOG_JSON_STREAM', '0') == '1'
+catalog_json_batch_size = int(os.environ.get('CATALOG_JSON_BATCH_SIZE', 1000))
+
+
+class LazyJsonList(list):
+    '''
+    A list that the json encoder walks by pulling values from an iterator,
+    so the encoded output can be produced without holding the whole list
+    '''
+
+    def __init__(self, iterable):
+        super(LazyJsonList, self).__init__()
+
+        # peek at the first value so that an empty list still encodes as []
+        self.iterator = iter(iterable)
+        self.first = next(self.iterator, None)
+
+    def __iter__(self):
+        if self.first is None:
+            return iter(())
+        return itertools.chain([self.first], self.iterator)
+
+    __nonzero__ = __bool__ = lambda self: self.first is not None
+
+
+def serializeCategory(category):
+    '''
+    Return Category.serialize of [category] with plain values only
+    '''
+    return {
+        'id': category.id,
+        'name': category.name,
+        'items': [plainItem(item) for item in category.items]
+    }
+
+
+def iterCategories(batch_size):
+    '''
+    Yield all Categories ordered by id, [batch_size] rows per query
+    '''
+    last_id = 0
+    while True:
+        categories = session.query(Category).filter_by(
+            deleted=False).filter(Category.id > last_id).order_by(
+            Category.id).limit(batch_size).all()
+        if not categories:
+            return
+        for category in categories:
+            yield category
+        last_id = categories[-1].id
+
+
+def iterItems(batch_size):
+    '''
+    Yield all Items ordered by category id then id, [batch_size] rows per
+    query
+    '''
+    last_category_id, last_id = 0, 0
+    while True:
+        items = session.query(Item).filter(or_(
+            Item.category_id > last_category_id,
+            and_(Item.category_id == last_category_id,
+                 Item.id > last_id))).order_by(
+            Item.category_id, Item.id).limit(batch_size).all()
+        if not items:
+            return
+        for item in items:
+            yield item
+        last_category_id, last_id = items[-1].category_id, items[-1].id
+
+
+def streamCatalogJson(batch_size):
+    '''
+    Generate /catalog.json in chunks, byte for byte the same document that
+    jsonify() builds from Category.serialize
+    '''
+    items = iterItems(batch_size)
+    pending = [next(items, None)]
+
+    def itemsOf(category):
+        # both streams are ordered by category id, so the items of a
+        # category are the ones at the head of the item stream
+        while pending[0] is not None \
+                and pending[0].category_id < category.id:
+            pending[0] = next(items, None)
+        while pending[0] is not None \
+                and pending[0].category_id == category.id:
+            yield plainItem(pending[0])
+            pending[0] = next(items, None)
+
+    def serializeCategories():
+        for category in iterCategories(batch_size):
+            yield {
+                'id': category.id,
+                'name': category.name,
+                'items': LazyJsonList(itemsOf(category))
+            }
+
+    # encode with the same settings jsonify() uses
+    indent, separators = jsonFormat()
+    encoder = app.json_encoder(
+        ensure_ascii=app.config['JSON_AS_ASCII'],
+        sort_keys=app.config['JSON_SORT_KEYS'],
+        indent=indent,
+        separators=separators)
+
+    # send the encoder's small fragments out in chunks of about 64KB
+    chunk = []
+    size = 0
+    for fragment in encoder.iterencode(
+            {'categories': LazyJsonList(serializeCategories())}):
+        chunk.append(fragment)
+        size += len(fragment)
+        if size >= 65536:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    chunk.append('\n')
+    yield ''.join(chunk)
+
+
+'''
+The last /catalog.json document served in each format is kept in memory
+together with its ETag and the catalog version it was built from.  Every
+write route bumps the catalog version in the database, so a cached document
+is reused only while its version is still current, in this process or any
+other.
+'''
+catalog_json_cache = {}
+catalog_json_lock = threading.Lock()
+
+
+def cacheCatalogJson(format, version, etag, body):
+    '''
+    Remember the /catalog.json ETag, and body if given, in [format] for
+    [version], with a dictionary to keep the body's compressed copies in;
+    return the cache entry
+    '''
+    with catalog_json_lock:
+        entry = catalog_json_cache.get(format)
+        if body is None and entry is not None \
+                and entry['version'] == version:
+            # a streamed response keeps the document and its compressed
+            # copies already cached for this version
+            entry['etag'] = etag
+        else:
+            entry = catalog_json_cache[format] = {
+                'version': version, 'etag': etag, 'body': body,
+                'compressed': {}}
+        return dict(entry)
+
+
+def streamCachedCatalogJson(version, batch_size):
+    '''
+    Stream /catalog.json and remember its ETag once it has all been sent
+    '''
+    etag = hashlib.md5()
+    for chunk in streamCatalogJson(batch_size):
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        etag.update(chunk)
+        yield chunk
+    cacheCatalogJson('json', version, etag.hexdigest(), None)
+
+
 @app.route('/catalog.json')
 def showCatalogJson():
     '''
-    Show Catalog in JSON format
+    Show Catalog in JSON format, or in MessagePack if the client asks for it
     '''
-    catalog = {}
-    categories = session.query(Category).all()
-    return jsonify(categories=[c.serialize for c in categories])
+    serializer = chooseSerializer()
+
+    # a page of categories when paging arguments are given; each links to
+    # the paged JSON of its items, so a page does not grow with them
+    if 'after' in request.args or 'limit' in request.args:
+        after, limit = getPageArgs()
+        categories, next_after = keysetPage(
+            session.query(Category).filter_by(deleted=False),
+            Category.id, after, limit)
+        return serializedResponse({
+            'categories': [{
+                'id': c.id,
+                'name': c.name,
+                'items_url': url_for(
+                    'showCategoryJson', category_name=c.name,
+                    category_id=c.id)} for c in categories],
+            'next': url_for('showCatalogJson', after=next_after, limit=limit)
+            if next_after is not None else None}, serializer)
+
+    version = getCatalogVersion(session)
+    with catalog_json_lock:
+        cached = dict(catalog_json_cache.get(serializer.name, {}))
+    if cached.get('version') != version:
+        cached = {'version': version, 'etag': None, 'body': None}
+
+    # the client already has the current catalog; its ETag is weak when
+    # the document was sent compressed
+    if cached['etag'] is not None \
+            and request.if_none_match.contains_weak(cached['etag']):
+        response = make_response('', 304)
+        response.set_etag(cached['etag'])
+        response.vary.add('Accept')
+        return response
+
+    # stream the JSON document in batches if requested
+    if serializer.name == 'json' and (
+            stream_catalog_json or request.args.get('stream') == '1'):
+        response = app.response_class(
+            stream_with_context(
+                streamCachedCatalogJson(version, catalog_json_batch_size)),
+            mimetype=serializer.mimetype)
+        if cached['etag'] is not None:
+            response.set_etag(cached['etag'])
+        response.vary.add('Accept')
+        return response
+
+    if cached['body'] is None:
+        # get all categories and, in one more query, all of their items so
+        # that serializing a category does not lazy-load its items
+        categories = session.query(Category).filter_by(
+            deleted=False).options(selectinload(Category.items)).all()
+        cached['body'] = serializer.dumps(
+            {'categories': [serializeCategory(c) for c in categories]})
+        cached['etag'] = hashlib.md5(cached['body']).hexdigest()
+        cached = cacheCatalogJson(
+            serializer.name, version, cached['etag'], cached['body'])
+
+    # send the document compressed once per catalog version, if the client
+    # accepts it
+    encoding = chooseEncoding()
+    if encoding is not None and len(cached['body']) >= compress_min_bytes:
+        response = app.response_class(
+            compressedBody(cached['body'], encoding, cached['compressed']),
+            mimetype=serializer.mimetype)
+        response.set_etag(cached['etag'])
+        setContentEncoding(response, encoding)
+    else:
+        response = app.response_class(
+            cached['body'], mimetype=serializer.mimetype)
+        response.set_etag(cached['etag'])
+    response.vary.add('Accept')
+    return response
+
+
+@app.route('/metrics')
+def showMetrics():
+    '''
+    Show request, database and cache metrics in the Prometheus text format
+    '''
+    output = metrics.render()
+    output += '# HELP catalog_fragment_cache_hits_total ' \
+        'Page fragments served from the cache.\n'
+    output += '# TYPE catalog_fragment_cache_hits_total counter\n'
+    output += 'catalog_fragment_cache_hits_total %d\n' % fragment_cache.hits
+    output += '# HELP catalog_fragment_cache_misses_total ' \
+        'Page fragments rendered.\n'
+    output += '# TYPE catalog_fragment_cache_misses_total counter\n'
+    output += 'catalog_fragment_cache_misses_total %d\n' \
+        % fragment_cache.misses
+    output += '# HELP catalog_user_cache_hits_total ' \
+        'User lookups served from the cache.\n'
+    output += '# TYPE catalog_user_cache_hits_total counter\n'
+    output += 'catalog_user_cache_hits_total %d\n' % user_cache.hits
+    output += '# HELP catalog_user_cache_misses_total ' \
+        'User lookups read from the database.\n'
+    output += '# TYPE catalog_user_cache_misses_total counter\n'
+    output += 'catalog_user_cache_misses_total %d\n' % user_cache.misses
+    output += '# HELP catalog_item_count_cache_hits_total ' \
+        'Category item counts served from the cache.\n'
+    output += '# TYPE catalog_item_count_cache_hits_total counter\n'
+    output += 'catalog_item_count_cache_hits_total %d\n' \
+        % category_item_counts.hits
+    output += '# HELP catalog_item_count_cache_misses_total ' \
+        'Category item counts read from the database.\n'
+    output += '# TYPE catalog_item_count_cache_misses_total counter\n'
+    output += 'catalog_item_count_cache_misses_total %d\n' \
+        % category_item_counts.misses
+
+    response = make_response(output, 200)
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    return response
 
 
 @app.route('/', methods=['GET', 'POST'])
@@ -662,6 +1712,52 @@ def showLogin():
     return render_template('login.html', STATE=state)
 
 
+class UserCache(object):
+    '''
+    The most recently used Users, looked up by email address or by id, at
+    most [size] of each.  Users are never changed once created, so cached
+    Users stay valid; only lookups that found a User are cached.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.users = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        '''
+        Return the value cached for [key], or None
+        '''
+        with self.lock:
+            value = self.users.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            # move the entry to the most recently used end
+            self.users[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        '''
+        Cache [value] for [key], dropping the least recently used entry when
+        the cache is full
+        '''
+        with self.lock:
+            self.users.pop(key, None)
+            self.users[key] = value
+            while len(self.users) > self.size:
+                self.users.popitem(last=False)
+
+
+'''
+CATALOG_USER_CACHE_SIZE bounds the number of user lookups kept in memory
+'''
+user_cache = UserCache(int(os.environ.get('CATALOG_USER_CACHE_SIZE', 10000)))
+
+
 def createUser(login_session):
     '''
     User Helper Functions
@@ -671,13 +1767,15 @@ def createUser(login_session):
     newUser = User(name=login_session['username'], email=login_session[
                    'email'], picture=login_session['picture'])
 
-    # add and commit user to database
+    # insert the user to get its unique ID, then commit it to database
     session.add(newUser)
+    session.flush()
+    user_id = newUser.id
     session.commit()
 
-    # query the User object from database and get its unique ID
-    user = session.query(User).filter_by(email=login_session['email']).one()
-    return user.id
+    # cache the new user's ID, replacing anything cached for its email
+    user_cache.put(('email', login_session['email']), user_id)
+    return user_id
 
 
 def getUserInfo(user_id):
@@ -685,23 +1783,39 @@ def getUserInfo(user_id):
     '''
     Query the database for a User based on its unique ID and return it
     '''
+    # a cached User is a detached copy, attached to this request's session
+    cached = user_cache.get(('id', user_id))
+    if cached is not None:
+        return session.merge(cached, load=False)
+
     try:
         user = session.query(User).filter_by(id=user_id).one()
-        return user
     except SQLAlchemyError:
         return None
 
+    copy = User(
+        id=user.id, name=user.name, email=user.email, picture=user.picture)
+    make_transient_to_detached(copy)
+    user_cache.put(('id', user_id), copy)
+    return user
+
 
 def getUserID(email):
     '''
     Query the database for a User based on its email address and return its ID
     '''
+    user_id = user_cache.get(('email', email))
+    if user_id is not None:
+        return user_id
+
     try:
-        user = session.query(User).filter_by(email=email).one()
-        return user.id
+        user_id, = session.query(User.id).filter_by(email=email).one()
     except SQLAlchemyError:
         return None
 
+    user_cache.put(('email', email), user_id)
+    return user_id
+
 
 def getUsername():
     '''
@@ -729,42 +1843,32 @@ def glogin():
 
     try:
         # Upgrade the authorization code into a credentials object
-        oauth_flow = flow_from_clientsecrets('client_secrets.json', scope='')
-        oauth_flow.redirect_uri = 'postmessage'
-        credentials = oauth_flow.step2_exchange(code)
+        oauth_flow = OAuth2WebServerFlow(
+            client_secrets['client_id'], client_secrets['client_secret'],
+            scope='', redirect_uri='postmessage',
+            auth_uri=client_secrets['auth_uri'],
+            token_uri=client_secrets['token_uri'],
+            revoke_uri=client_secrets.get('revoke_uri'))
+        credentials = oauth_flow.step2_exchange(
+            code, http=PooledHttp(http_session, http_timeout))
     except FlowExchangeError:
         response = make_response(
             json.dumps('Failed to upgrade the authorization code.'), 401)
         response.headers['Content-Type'] = 'application/json'
         return response
 
-    # Check that the access token is valid.
-    access_token = credentials.access_token
-    url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?access_token=%s'
-           % access_token)
-    h = httplib2.Http()
-    result = json.loads(h.request(url, 'GET')[1])
-    # If there was an error in the access token info, abort.
-    if result.get('error') is not None:
-        response = make_response(json.dumps(result.get('error')), 500)
-        response.headers['Content-Type'] = 'application/json'
-        return response
-
-    # Verify that the access token is used for the intended user.
-    gplus_id = credentials.id_token['sub']
-    if result['user_id'] != gplus_id:
-        response = make_response(
-            json.dumps("Token's user ID doesn't match given user ID."), 401)
-        response.headers['Content-Type'] = 'application/json'
-        return response
-
-    # Verify that the access token is valid for this app.
-    if result['issued_to'] != CLIENT_ID:
-        response = make_response(
-            json.dumps("Token's client ID does not match app's."), 401)
-        print "Token's client ID does not match app's."
+    # Check locally that the ID token was signed by Google for this app,
+    # instead of asking Google for the access token info.
+    try:
+        id_token = verifyIdToken(
+            credentials.token_response.get('id_token'), google_keys,
+            CLIENT_ID)
+    except TokenError as e:
+        print "Invalid ID token: %s" % e
+        response = make_response(json.dumps('Invalid ID token.'), 401)
         response.headers['Content-Type'] = 'application/json'
         return response
+    gplus_id = id_token['sub']
 
     stored_access_token = login_session.get('access_token')
     stored_gplus_id = login_session.get('gplus_id')
@@ -779,12 +1883,15 @@ def glogin():
     login_session['access_token'] = credentials.access_token
     login_session['gplus_id'] = gplus_id
 
-    # Get user info
-    userinfo_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-    params = {'access_token': credentials.access_token, 'alt': 'json'}
-    answer = requests.get(userinfo_url, params=params)
-
-    data = answer.json()
+    # Get user info from the ID token, or from Google if the token lacks
+    # the profile
+    data = id_token
+    if not all(key in data for key in ('name', 'picture', 'email')):
+        userinfo_url = "https://www.googleapis.com/oauth2/v1/userinfo"
+        params = {'access_token': credentials.access_token, 'alt': 'json'}
+        answer = http_session.get(
+            userinfo_url, params=params, timeout=http_timeout)
+        data = answer.json()
 
     login_session['username'] = data['name']
     login_session['picture'] = data['picture']
@@ -824,16 +1931,16 @@ def glogout():
             json.dumps('Current user not connected.'), 401)
         response.headers['Content-Type'] = 'application/json'
         return response
-    url = 'https://accounts.google.com/o/oauth2/revoke?token=%s' % access_token
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[0]
-    if result['status'] == '200':
-        response = make_response(json.dumps('Successfully disconnected.'), 200)
+
+    # revoke the token in the background instead of waiting on Google
+    if token_revoker.revoke(access_token):
+        response = make_response(
+            json.dumps('Token revocation requested.'), 202)
         response.headers['Content-Type'] = 'application/json'
         return response
     else:
         response = make_response(
-            json.dumps('Failed to revoke token for given user.', 400))
+            json.dumps('Failed to revoke token for given user.'), 503)
         response.headers['Content-Type'] = 'application/json'
         return response
 
@@ -862,6 +1969,8 @@ def logout():
 
 
 if __name__ == '__main__':
-    app.secret_key = "specialsecretkey"
+    # the development server runs with a fixed key unless one is given
+    os.environ.setdefault('CATALOG_SECRET_KEY', 'specialsecretkey')
+    createApp()
     app.debug = True
-    app.run(host='0.0.0.0', port=8000, threaded=False)
+    app.run(host='0.0.0.0', port=8000, threaded=True)
@@ -0,0 +1,237 @@
+import Queue
+import base64
+import json
+import re
+import threading
+import time
+import httplib2
+import requests
+from requests.adapters import HTTPAdapter
+from oauth2client import crypt
+
+'''
+Google Sign-In helpers of the catalog application.
+
+The ID token returned with a user's credentials is verified locally against
+Google's signing keys, which are fetched once and kept until they expire, so
+a login does not wait on a tokeninfo request.  The remaining calls to Google
+share one pool of keep-alive connections, and tokens are revoked at logout
+by background threads.
+'''
+
+
+class TokenError(Exception):
+    '''
+    An ID token that cannot be trusted
+    '''
+
+
+def createHttpSession(pool_size):
+    '''
+    Return a requests session keeping up to [pool_size] connections open per
+    host, shared by every thread
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class PooledHttp(object):
+    '''
+    The httplib2.Http interface oauth2client calls, served by the pooled
+    requests session [session] instead of a new connection per call
+    '''
+
+    def __init__(self, session, timeout):
+        self.session = session
+        self.timeout = timeout
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        response = self.session.request(
+            method, uri, data=body, headers=headers, timeout=self.timeout)
+        info = dict(
+            (name.lower(), value) for name, value in response.headers.items())
+        info['status'] = str(response.status_code)
+        return httplib2.Response(info), response.content
+
+
+class KeySet(object):
+    '''
+    The public keys an identity provider signs its ID tokens with, read from
+    [url] and kept for as long as the provider's Cache-Control allows, or
+    [max_age] seconds.  A token signed with an unknown key refetches the keys
+    early, at most once every [min_refresh] seconds.
+    '''
+
+    def __init__(self, url, http, timeout, max_age=3600, min_refresh=60):
+        self.url = url
+        self.http = http
+        self.timeout = timeout
+        self.max_age = max_age
+        self.min_refresh = min_refresh
+        self.lock = threading.Lock()
+        self.verifiers = {}
+        self.fetched = 0
+        self.expires = 0
+
+    def refresh(self):
+        '''
+        Fetch the current keys and parse each of them once
+        '''
+        response = self.http.get(self.url, timeout=self.timeout)
+        response.raise_for_status()
+
+        # the key set maps key ids to PEM certificates or public keys
+        self.verifiers = dict(
+            (kid, crypt.Verifier.from_string(pem, 'CERTIFICATE' in pem))
+            for kid, pem in response.json().items())
+
+        max_age = re.search(
+            r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+        self.fetched = time.time()
+        self.expires = self.fetched + (
+            int(max_age.group(1)) if max_age else self.max_age)
+
+    def verifier(self, kid):
+        '''
+        Return the verifier of key [kid], or None if there is no such key
+        '''
+        with self.lock:
+            now = time.time()
+            if now >= self.expires or (
+                    kid not in self.verifiers
+                    and now - self.fetched >= self.min_refresh):
+                try:
+                    self.refresh()
+                except (requests.RequestException, ValueError) as e:
+                    # keep verifying with the keys we have
+                    if not self.verifiers:
+                        raise TokenError('Signing keys unavailable: %s' % e)
+            return self.verifiers.get(kid)
+
+
+def decodeSegment(segment):
+    '''
+    Return the bytes of a base64url encoded JWT segment
+    '''
+    return base64.urlsafe_b64decode(
+        str(segment) + '=' * (-len(segment) % 4))
+
+
+def verifyIdToken(token, key_set, audience,
+                  issuers=('accounts.google.com',
+                           'https://accounts.google.com'),
+                  clock_skew=300):
+    '''
+    Check the signature, issuer, audience and lifetime of the ID [token]
+    against the keys of [key_set] and return its claims
+    '''
+    try:
+        header, payload, signature = str(token).split('.')
+        kid = json.loads(decodeSegment(header)).get('kid')
+        claims = json.loads(decodeSegment(payload))
+        signature = decodeSegment(signature)
+    except (ValueError, TypeError, UnicodeError):
+        raise TokenError('Malformed ID token')
+
+    verifier = key_set.verifier(kid)
+    if verifier is None \
+            or not verifier.verify(header + '.' + payload, signature):
+        raise TokenError('Invalid ID token signature')
+
+    if claims.get('iss') not in issuers:
+        raise TokenError('Wrong ID token issuer: %s' % claims.get('iss'))
+    if claims.get('aud') != audience:
+        raise TokenError('Wrong ID token audience: %s' % claims.get('aud'))
+
+    now = time.time()
+    if claims.get('iat', 0) > now + clock_skew:
+        raise TokenError('ID token issued in the future')
+    if claims.get('exp', 0) < now - clock_skew:
+        raise TokenError('ID token expired')
+    return claims
+
+
+class TokenRevoker(object):
+    '''
+    Revoke access tokens at [url] on [workers] background threads, so that
+    logging out does not wait on the identity provider.  At most
+    [queue_size] tokens wait to be revoked; a failed revocation is retried
+    up to [retries] times, waiting [backoff] seconds, then twice as long
+    after each attempt.
+    '''
+
+    def __init__(self, url, http, timeout, workers=2, queue_size=1000,
+                 retries=3, backoff=1.0):
+        self.url = url
+        self.http = http
+        self.timeout = timeout
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = Queue.Queue(queue_size)
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def start(self):
+        '''
+        Start the worker threads if they are not running yet
+        '''
+        with self.lock:
+            if self.threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(
+                    target=self.work, name='revoke-%d' % index)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def revoke(self, token):
+        '''
+        Queue [token] to be revoked; return False if the queue is full
+        '''
+        self.start()
+        try:
+            self.queue.put_nowait(token)
+            return True
+        except Queue.Full:
+            print "Token revocation queue full, token not revoked"
+            return False
+
+    def work(self):
+        '''
+        Revoke the queued tokens one by one
+        '''
+        while True:
+            token = self.queue.get()
+            try:
+                self.revokeNow(token)
+            finally:
+                self.queue.task_done()
+
+    def revokeNow(self, token):
+        '''
+        Revoke [token], retrying when the provider is unreachable or failing;
+        return True if it was revoked
+        '''
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                response = self.http.post(
+                    self.url, params={'token': token}, timeout=self.timeout)
+            except requests.RequestException as e:
+                error = e
+                continue
+
+            if response.status_code == 200:
+                return True
+            # an expired or already revoked token is answered with 400
+            error = 'status %d' % response.status_code
+            if response.status_code < 500 and response.status_code != 429:
+                break
+        print "Failed to revoke token: %s" % error
+        return False
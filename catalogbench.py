@@ -0,0 +1,246 @@
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import time
+
+'''
+Benchmark the routes of catalog.py against a synthetic catalog.
+
+A catalog of the chosen scale is generated into its own working directory,
+then every route is driven through Flask's test client and its throughput
+and p50/p95/p99 latencies are written to a JSON file.
+
+    python2 catalogbench.py --scale 1k
+    python2 catalogbench.py --scale 100k --requests 500 --output bench.json
+'''
+
+scales = {'1k': 1000, '100k': 100000, '1m': 1000000}
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def generateCatalog(items, categories):
+    '''
+    Fill the catalog database of the working directory with [items] items
+    spread over [categories] categories
+    '''
+    import catalogimport
+
+    def rows():
+        for category in range(categories):
+            yield {'category': u'Category %d' % category}
+        for item in range(items):
+            yield {
+                'category': u'Category %d' % (item % categories),
+                'name': u'Item %d' % item,
+                'description': u'Description of synthetic item %d in '
+                               u'category %d' % (item, item % categories)}
+
+    user_id = catalogimport.getUser('Admin', 'admin@catalog.py')
+    catalogimport.importCatalog(rows(), user_id, 50000)
+    return user_id
+
+
+def percentile(timings, fraction):
+    '''
+    Return the nearest-rank [fraction] percentile of sorted [timings]
+    '''
+    index = int(math.ceil(fraction * len(timings))) - 1
+    return timings[max(0, min(index, len(timings) - 1))]
+
+
+def measure(client, name, urls, method='GET', data=None):
+    '''
+    Request every url of [urls] and return the statistics of route [name]
+    '''
+    timings = []
+    errors = 0
+    start = time.time()
+    for url in urls:
+        before = time.time()
+        if method == 'POST':
+            response = client.post(url, data=data(url) if data else {})
+        else:
+            response = client.get(url)
+        response.get_data()
+        timings.append(time.time() - before)
+        if response.status_code >= 400:
+            errors += 1
+    elapsed = time.time() - start
+
+    timings.sort()
+    stats = {
+        'requests': len(timings),
+        'errors': errors,
+        'throughput_rps': round(len(timings) / elapsed, 1) if elapsed else 0,
+        'p50_ms': round(percentile(timings, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(timings, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(timings, 0.99) * 1000, 2),
+    }
+    print "%-24s %8.1f req/s  p50 %8.2f ms  p95 %8.2f ms  p99 %8.2f ms" \
+        "  %d errors" % (
+            name, stats['throughput_rps'], stats['p50_ms'], stats['p95_ms'],
+            stats['p99_ms'], errors)
+    return stats
+
+
+def runBenchmark(requests, json_requests, user_id):
+    '''
+    Drive every route of catalog.py and return the statistics per route
+    '''
+    import catalog
+    from database_setup import Category, Item
+
+    os.environ.setdefault('CATALOG_SECRET_KEY', 'catalogbench')
+    catalog.createApp()
+    client = catalog.app.test_client()
+    with client.session_transaction() as login_session:
+        login_session['username'] = 'Admin'
+        login_session['email'] = 'admin@catalog.py'
+        login_session['picture'] = ''
+        login_session['user_id'] = user_id
+        login_session['provider'] = 'catalogbench'
+
+    # pick the categories and items to request
+    session = catalog.session
+    categories = session.query(Category.id, Category.name).filter_by(
+        deleted=False).all()
+    max_item = session.query(Item.id).order_by(Item.id.desc()).first()[0]
+    items = session.query(Item.id, Item.name, Category.name).join(
+        Category, Item.category_id == Category.id).filter(
+        Item.id.in_(random.sample(
+            xrange(1, max_item + 1), min(requests, max_item)))).all()
+    catalog.session.remove()
+
+    def sample(urls, count):
+        return [random.choice(urls) for _ in range(count)]
+
+    results = {}
+    results['home'] = measure(client, 'home', ['/'] * requests)
+    results['category_page'] = measure(client, 'category_page', sample(
+        ['/catalog/%s/%d/items' % (name, id) for id, name in categories],
+        requests))
+    results['item_page'] = measure(client, 'item_page', sample(
+        ['/catalog/%s/%s/%d' % (category, name, id)
+         for id, name, category in items], requests))
+    results['item_json'] = measure(client, 'item_json', sample(
+        ['/catalog/%s/%s/%d/JSON' % (category, name, id)
+         for id, name, category in items], requests))
+    results['catalog_json'] = measure(
+        client, 'catalog_json', ['/catalog.json'] * json_requests)
+    results['catalog_json_stream'] = measure(
+        client, 'catalog_json_stream',
+        ['/catalog.json?stream=1'] * json_requests)
+    results['catalog_json_page'] = measure(
+        client, 'catalog_json_page', ['/catalog.json?limit=100'] * requests)
+    results['search'] = measure(client, 'search', sample(
+        ['/catalog/search?q=item+%d' % random.randint(0, max_item)
+         for _ in range(100)], requests))
+
+    # write routes, each working on the rows the previous one created
+    results['create_category'] = measure(
+        client, 'create_category',
+        ['/catalog/category/new'] * requests, 'POST',
+        lambda url: {
+            'name': 'Bench Category %d' % random.randint(0, 10 ** 9)})
+    bench_categories = session.query(Category.id, Category.name).filter(
+        Category.name.like('Bench Category %')).all()
+    catalog.session.remove()
+    results['edit_category'] = measure(
+        client, 'edit_category',
+        ['/catalog/%s/%d/edit' % (name, id)
+         for id, name in bench_categories], 'POST',
+        lambda url: {'name': url.split('/')[2]})
+    results['create_item'] = measure(
+        client, 'create_item', ['/catalog/item/new'] * requests, 'POST',
+        lambda url: {
+            'name': 'Bench Item', 'description': 'Created by catalogbench',
+            'categories': str(random.choice(bench_categories)[0])})
+    results['add_item_to_category'] = measure(
+        client, 'add_item_to_category',
+        ['/catalog/%s/%d/item/new' % (name, id)
+         for id, name in bench_categories], 'POST',
+        lambda url: {
+            'name': 'Bench Item', 'description': 'Added by catalogbench',
+            'categories': url.split('/')[3]})
+    bench_items = session.query(Item.id, Category.name).join(
+        Category, Item.category_id == Category.id).filter(
+        Item.name == 'Bench Item').all()
+    catalog.session.remove()
+    results['edit_item'] = measure(
+        client, 'edit_item',
+        ['/catalog/%s/Bench Item/%d/edit' % (category, id)
+         for id, category in bench_items[:requests]], 'POST',
+        lambda url: {
+            'name': 'Bench Item', 'description': 'Edited by catalogbench',
+            'categories': str(random.choice(bench_categories)[0])})
+    results['delete_item'] = measure(
+        client, 'delete_item',
+        ['/catalog/%s/Bench Item/%d/delete' % (category, id)
+         for id, category in bench_items[:requests]], 'POST')
+    results['delete_category'] = measure(
+        client, 'delete_category',
+        ['/catalog/%s/%d/delete' % (name, id)
+         for id, name in bench_categories], 'POST')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the catalog routes on a synthetic catalog')
+    parser.add_argument(
+        '--scale', choices=sorted(scales), default='1k',
+        help='number of items in the synthetic catalog')
+    parser.add_argument(
+        '--items-per-category', type=int, default=100,
+        help='average number of items per category')
+    parser.add_argument(
+        '--requests', type=int, default=200,
+        help='number of requests per route')
+    parser.add_argument(
+        '--json-requests', type=int, default=5,
+        help='number of requests for the full /catalog.json routes')
+    parser.add_argument(
+        '--workdir', help='directory holding the synthetic catalog, '
+        'bench-<scale> by default; an existing catalog there is reused')
+    parser.add_argument(
+        '--output', default='bench_output.json',
+        help='file the results are written to')
+    args = parser.parse_args()
+
+    items = scales[args.scale]
+    workdir = os.path.abspath(args.workdir or 'bench-%s' % args.scale)
+    output = os.path.abspath(args.output)
+
+    # the application reads its client secrets from the current directory
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    shutil.copy(os.path.join(here, 'client_secrets.json'), workdir)
+    database = os.path.join(workdir, 'catalogwithusers.db')
+    generate = not os.path.exists(database)
+    os.environ['CATALOG_DATABASE_URL'] = 'sqlite:///' + database
+    os.chdir(workdir)
+    sys.path.insert(0, here)
+
+    import database_setup
+    database_setup.createSchema(database_setup.createCatalogEngine())
+    if generate:
+        print "Generating a catalog of %d items in %s" % (items, workdir)
+        user_id = generateCatalog(
+            items, max(1, items // args.items_per_category))
+    else:
+        import catalogimport
+        user_id = catalogimport.getUser('Admin', 'admin@catalog.py')
+
+    results = runBenchmark(args.requests, args.json_requests, user_id)
+    with open(output, 'w') as f:
+        json.dump({
+            'scale': args.scale,
+            'items': items,
+            'requests': args.requests,
+            'routes': results}, f, indent=2, sort_keys=True)
+    print "Results written to %s" % output
@@ -0,0 +1,129 @@
+import gzip
+import io
+import os
+import zlib
+from flask import request
+
+'''
+Compression of the catalog application's responses.
+
+Responses of at least CATALOG_COMPRESS_MIN_BYTES bytes are compressed with
+brotli, when the brotli package is installed and the client accepts it, or
+else with gzip.  Callers that cache a response body can keep its compressed
+copies with it through compressedBody(), so that each is compressed once.
+'''
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+compress_min_bytes = int(os.environ.get('CATALOG_COMPRESS_MIN_BYTES', 1024))
+gzip_level = int(os.environ.get('CATALOG_GZIP_LEVEL', 6))
+brotli_quality = int(os.environ.get('CATALOG_BROTLI_QUALITY', 5))
+
+'''
+The encodings offered to clients, preferred first
+'''
+encodings = (['br'] if brotli is not None else []) + ['gzip']
+
+compressible_mimetypes = set([
+    'application/json', 'application/msgpack', 'application/javascript',
+    'application/xml', 'image/svg+xml'])
+
+
+def chooseEncoding():
+    '''
+    Return the content encoding the current request accepts, or None
+    '''
+    best = request.accept_encodings.best_match(encodings)
+    return best if best in encodings else None
+
+
+def compressBody(body, encoding):
+    '''
+    Return the bytes [body] compressed with [encoding]
+    '''
+    if encoding == 'br':
+        return brotli.compress(body, quality=brotli_quality)
+    out = io.BytesIO()
+    # a fixed modification time makes the output depend on the body only
+    with gzip.GzipFile(
+            fileobj=out, mode='wb', compresslevel=gzip_level, mtime=0) as f:
+        f.write(body)
+    return out.getvalue()
+
+
+def compressedBody(body, encoding, cache):
+    '''
+    Return [body] compressed with [encoding], keeping the result in the
+    dictionary [cache] of the body's compressed copies
+    '''
+    compressed = cache.get(encoding)
+    if compressed is None:
+        compressed = cache[encoding] = compressBody(body, encoding)
+    return compressed
+
+
+def isCompressible(response):
+    '''
+    Return True if [response] is worth compressing
+    '''
+    return response.status_code == 200 \
+        and 'Content-Encoding' not in response.headers \
+        and not response.direct_passthrough \
+        and (response.mimetype.startswith('text/')
+             or response.mimetype in compressible_mimetypes)
+
+
+def gzipStream(chunks):
+    '''
+    Yield the gzip compressed stream of the byte strings [chunks]
+    '''
+    # a window size above 16 makes zlib write the gzip format
+    compressor = zlib.compressobj(
+        gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def setContentEncoding(response, encoding):
+    '''
+    Mark [response] as compressed with [encoding]; its ETag becomes weak,
+    since it no longer names the exact bytes of the uncompressed body
+    '''
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+
+
+def compressResponse(response):
+    '''
+    Compress [response] in the encoding the request accepts, if it is large
+    enough; streamed responses are gzip compressed as they are sent
+    '''
+    response.vary.add('Accept-Encoding')
+    if not isCompressible(response):
+        return response
+    encoding = chooseEncoding()
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        if not request.accept_encodings.quality('gzip'):
+            return response
+        response.response = gzipStream(response.iter_encoded())
+        response.headers.pop('Content-Length', None)
+        setContentEncoding(response, 'gzip')
+        return response
+
+    body = response.get_data()
+    if len(body) < compress_min_bytes:
+        return response
+    response.set_data(compressBody(body, encoding))
+    setContentEncoding(response, encoding)
+    return response
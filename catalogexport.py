@@ -0,0 +1,129 @@
+import argparse
+import collections
+import csv
+import json
+import sys
+import time
+from sqlalchemy import select, or_, false
+from database_setup import Category, Item, createCatalogEngine
+
+'''
+Export the items or the categories of the catalog database to a JSON Lines
+or CSV file.  Rows are read in batches ordered by id, so memory use does not
+grow with the size of the catalog.
+
+Items are written with the fields of Item.serialize plus the name of their
+'category', so an export can be loaded again with catalogimport.py.
+
+    python2 catalogexport.py items.jsonl
+    python2 catalogexport.py --table categories categories.csv
+    python2 catalogexport.py --format csv - > items.csv
+'''
+
+engine = createCatalogEngine()
+
+item = Item.__table__
+category = Category.__table__
+
+'''
+The columns written for each table, in order
+'''
+columns = {
+    'items': [
+        item.c.name, item.c.id, item.c.description, item.c.category_id,
+        item.c.user_id, item.c.created, category.c.name.label('category')],
+    'categories': [category.c.id, category.c.name, category.c.user_id],
+}
+
+
+def iterRows(connection, table, batch_size):
+    '''
+    Yield the rows of [table] ordered by id, [batch_size] rows per query
+    '''
+    # leave out deleted categories and the items still waiting to be purged
+    # with them
+    if table == 'items':
+        query = select(columns[table]).select_from(
+            item.outerjoin(category, item.c.category_id == category.c.id)
+        ).where(or_(category.c.deleted == false(), category.c.id == None))
+        key = item.c.id
+    else:
+        query = select(columns[table]).where(category.c.deleted == false())
+        key = category.c.id
+
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            query.where(key > last_id).order_by(key).limit(batch_size)
+        ).fetchall()
+        if not rows:
+            return
+        for row in rows:
+            yield row
+        last_id = rows[-1][key]
+
+
+def formatValue(value):
+    '''
+    Return [value] as it is written to the export file
+    '''
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def exportCatalog(out, table, format, batch_size):
+    '''
+    Write the rows of [table] to the file [out] and return their number
+    '''
+    names = [column.name for column in columns[table]]
+    if format == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(names)
+
+    start = time.time()
+    count = 0
+    with engine.connect() as connection:
+        for row in iterRows(connection, table, batch_size):
+            values = [formatValue(value) for value in row]
+            if format == 'csv':
+                writer.writerow([
+                    value.encode('utf-8') if isinstance(value, unicode)
+                    else value for value in values])
+            else:
+                out.write(json.dumps(
+                    collections.OrderedDict(zip(names, values))))
+                out.write('\n')
+
+            count += 1
+            if count % batch_size == 0:
+                print >> sys.stderr, "%d rows exported" % count
+
+    elapsed = time.time() - start
+    print >> sys.stderr, "Exported %d %s in %.1f seconds (%.0f rows/sec)" \
+        % (count, table, elapsed, count / elapsed if elapsed else 0)
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export the catalog to JSON Lines or CSV')
+    parser.add_argument(
+        'path', help='file to write, or - for the standard output')
+    parser.add_argument(
+        '--table', choices=['items', 'categories'], default='items',
+        help='rows to export')
+    parser.add_argument(
+        '--format', choices=['csv', 'jsonl'],
+        help='file format, guessed from the file extension by default')
+    parser.add_argument(
+        '--batch-size', type=int, default=10000,
+        help='number of rows read per query')
+    args = parser.parse_args()
+
+    format = args.format or ('csv' if args.path.endswith('.csv') else 'jsonl')
+    if args.path == '-':
+        exportCatalog(sys.stdout, args.table, format, args.batch_size)
+    else:
+        with open(args.path, 'wb') as out:
+            exportCatalog(out, args.table, format, args.batch_size)
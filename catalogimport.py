@@ -0,0 +1,142 @@
+import argparse
+import csv
+import json
+import sys
+import time
+from sqlalchemy.orm import sessionmaker
+from database_setup import Category, Item, User
+from database_setup import bumpCatalogVersion, CATEGORIES_VERSION
+from database_setup import createCatalogEngine
+
+'''
+Bulk import categories and items into the catalog database from a CSV file
+with a header row, or from a JSON Lines file with one object per line.
+
+Every row names a 'category'.  Rows that also have a 'name' add an item with
+that name and the optional 'description' to the category; rows without one
+only create the category.  Categories are created as they are first seen.
+
+    python2 catalogimport.py items.csv
+    python2 catalogimport.py --batch-size 50000 items.jsonl
+'''
+
+engine = createCatalogEngine()
+
+DBSession = sessionmaker(bind=engine)
+session = DBSession()
+
+
+def readRows(path, format):
+    '''
+    Yield the rows of a CSV or JSON Lines file as dictionaries
+    '''
+    with open(path, 'rb') as f:
+        if format == 'csv':
+            for row in csv.DictReader(f):
+                yield dict(
+                    (key, value.decode('utf-8') if value else None)
+                    for key, value in row.items())
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def getUser(name, email):
+    '''
+    Return the id of the user owning the imported rows, creating it if needed
+    '''
+    user = session.query(User).filter_by(email=email).first()
+    if user is None:
+        user = User(name=name, email=email)
+        session.add(user)
+        session.commit()
+    return user.id
+
+
+def importCatalog(rows, user_id, batch_size):
+    '''
+    Insert [rows] owned by [user_id], committing every [batch_size] items,
+    and return the number of rows read
+    '''
+    # resolve every existing category name to its id once; where names are
+    # repeated the oldest category, read last, wins.  Deleted categories are
+    # being purged, so their names make new categories.
+    category_ids = {}
+    for id, name in session.query(Category.id, Category.name).filter_by(
+            deleted=False).order_by(Category.id.desc()):
+        category_ids[name] = id
+
+    start = time.time()
+    count = 0
+    batch = []
+    new_categories = False
+
+    def flush():
+        if batch:
+            session.execute(Item.__table__.insert(), batch)
+        bumpCatalogVersion(session)
+        if new_categories:
+            bumpCatalogVersion(session, CATEGORIES_VERSION)
+        session.commit()
+        del batch[:]
+
+    for row in rows:
+        count += 1
+
+        # create the category the first time its name is seen
+        category_name = row.get('category')
+        if not category_name:
+            print >> sys.stderr, "Skipping row %d without a category" % count
+            continue
+        if category_name not in category_ids:
+            category_ids[category_name] = session.execute(
+                Category.__table__.insert().values(
+                    name=category_name, user_id=user_id)
+            ).inserted_primary_key[0]
+            new_categories = True
+
+        if row.get('name'):
+            batch.append({
+                'name': row['name'],
+                'description': row.get('description'),
+                'category_id': category_ids[category_name],
+                'user_id': user_id})
+
+        if len(batch) >= batch_size:
+            flush()
+            new_categories = False
+            elapsed = time.time() - start
+            print "%d rows imported (%.0f rows/sec)" \
+                % (count, count / elapsed if elapsed else 0)
+
+    flush()
+    elapsed = time.time() - start
+    print "Imported %d rows into %d categories in %.1f seconds " \
+        "(%.0f rows/sec)" \
+        % (count, len(category_ids), elapsed,
+           count / elapsed if elapsed else 0)
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Bulk import categories and items into the catalog')
+    parser.add_argument('path', help='CSV or JSON Lines file to import')
+    parser.add_argument(
+        '--format', choices=['csv', 'jsonl'],
+        help='file format, guessed from the file extension by default')
+    parser.add_argument(
+        '--batch-size', type=int, default=10000,
+        help='number of items inserted per transaction')
+    parser.add_argument(
+        '--user-name', default='Admin',
+        help='name of the user owning the imported rows')
+    parser.add_argument(
+        '--user-email', default='admin@catalog.py',
+        help='email of the user owning the imported rows')
+    args = parser.parse_args()
+
+    format = args.format or ('csv' if args.path.endswith('.csv') else 'jsonl')
+    user_id = getUser(args.user_name, args.user_email)
+    importCatalog(readRows(args.path, format), user_id, args.batch_size)
@@ -0,0 +1,334 @@
+import Queue
+import logging
+import logging.handlers
+import threading
+import time
+from flask import g, request, has_request_context
+from sqlalchemy import event
+
+'''
+Request and database metrics of the catalog application, exposed in the
+Prometheus text format.
+
+Every request is counted by endpoint, method and status code, and its
+latency, number of SQL queries and time spent in the database are recorded
+by endpoint.  Metrics are kept per process.
+
+Queries slower than a threshold can also be written to a slow query log
+together with their query plan, which a background thread reads on a
+connection of its own.
+'''
+
+'''
+Upper bounds of the histogram buckets for request latency in seconds and
+for the number of queries run by a request
+'''
+latency_buckets = [
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+query_buckets = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+
+class Histogram(object):
+    '''
+    Counts of observed values per bucket, plus their sum and count
+    '''
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        '''
+        Return the Prometheus text lines of this histogram
+        '''
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (
+                name, formatLabels(labels + [('le', repr(float(bound)))]),
+                cumulative))
+        lines.append('%s_bucket%s %d' % (
+            name, formatLabels(labels + [('le', '+Inf')]), self.count))
+        lines.append('%s_sum%s %r' % (name, formatLabels(labels), self.sum))
+        lines.append(
+            '%s_count%s %d' % (name, formatLabels(labels), self.count))
+        return lines
+
+
+def formatLabels(labels):
+    '''
+    Return [labels], a list of (name, value) pairs, as a Prometheus label set
+    '''
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, unicode(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n'))
+        for name, value in labels)
+
+
+class Metrics(object):
+    '''
+    The metrics of all requests served by this process
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.latency = {}
+        self.queries = {}
+        self.query_count = {}
+        self.query_time = {}
+
+    def observeRequest(self, endpoint, method, status, duration, queries,
+                       query_time):
+        '''
+        Record one request to [endpoint] and the queries it ran
+        '''
+        with self.lock:
+            key = (endpoint, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            if endpoint not in self.latency:
+                self.latency[endpoint] = Histogram(latency_buckets)
+                self.queries[endpoint] = Histogram(query_buckets)
+                self.query_count[endpoint] = 0
+                self.query_time[endpoint] = 0.0
+            self.latency[endpoint].observe(duration)
+            self.queries[endpoint].observe(queries)
+            self.query_count[endpoint] += queries
+            self.query_time[endpoint] += query_time
+
+    def render(self):
+        '''
+        Return all metrics in the Prometheus text format
+        '''
+        with self.lock:
+            lines = [
+                '# HELP catalog_http_requests_total Requests served.',
+                '# TYPE catalog_http_requests_total counter']
+            for (endpoint, method, status), count in sorted(
+                    self.requests.items()):
+                lines.append('catalog_http_requests_total%s %d' % (
+                    formatLabels([
+                        ('endpoint', endpoint), ('method', method),
+                        ('status', status)]), count))
+
+            lines += [
+                '# HELP catalog_http_request_duration_seconds '
+                'Request latency.',
+                '# TYPE catalog_http_request_duration_seconds histogram']
+            for endpoint in sorted(self.latency):
+                lines += self.latency[endpoint].render(
+                    'catalog_http_request_duration_seconds',
+                    [('endpoint', endpoint)])
+
+            lines += [
+                '# HELP catalog_db_queries_per_request '
+                'SQL queries run by a request.',
+                '# TYPE catalog_db_queries_per_request histogram']
+            for endpoint in sorted(self.queries):
+                lines += self.queries[endpoint].render(
+                    'catalog_db_queries_per_request',
+                    [('endpoint', endpoint)])
+
+            lines += [
+                '# HELP catalog_db_queries_total SQL queries run.',
+                '# TYPE catalog_db_queries_total counter']
+            for endpoint in sorted(self.query_count):
+                lines.append('catalog_db_queries_total%s %d' % (
+                    formatLabels([('endpoint', endpoint)]),
+                    self.query_count[endpoint]))
+
+            lines += [
+                '# HELP catalog_db_query_duration_seconds_total '
+                'Time spent running SQL queries.',
+                '# TYPE catalog_db_query_duration_seconds_total counter']
+            for endpoint in sorted(self.query_time):
+                lines.append(
+                    'catalog_db_query_duration_seconds_total%s %r' % (
+                        formatLabels([('endpoint', endpoint)]),
+                        self.query_time[endpoint]))
+        return '\n'.join(lines) + '\n'
+
+
+def instrumentApp(app, metrics):
+    '''
+    Record the requests served by [app] into [metrics]; call
+    instrumentEngine() for every engine the requests use to count their
+    queries
+    '''
+
+    @app.before_request
+    def startRequestMetrics():
+        g.metrics_start = time.time()
+        g.metrics_queries = 0
+        g.metrics_query_time = 0.0
+
+    @app.after_request
+    def recordResponseStatus(response):
+        g.metrics_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def recordRequestMetrics(exception=None):
+        # streamed responses are torn down once the stream has been sent
+        if 'metrics_start' not in g:
+            return
+        metrics.observeRequest(
+            request.endpoint or 'unknown', request.method,
+            g.get('metrics_status', 500), time.time() - g.metrics_start,
+            g.metrics_queries, g.metrics_query_time)
+
+
+def instrumentEngine(engine):
+    '''
+    Count the queries run on [engine] in the metrics of the current request
+    '''
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def startQueryTimer(conn, cursor, statement, parameters, context,
+                        executemany):
+        conn.info.setdefault('metrics_query_start', []).append(time.time())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def recordQueryTime(conn, cursor, statement, parameters, context,
+                        executemany):
+        elapsed = time.time() - conn.info['metrics_query_start'].pop()
+        if has_request_context() and 'metrics_start' in g:
+            g.metrics_queries += 1
+            g.metrics_query_time += elapsed
+
+    @event.listens_for(engine, 'handle_error')
+    def dropQueryTimer(context):
+        conn = context.connection
+        if conn is not None and conn.info.get('metrics_query_start'):
+            conn.info['metrics_query_start'].pop()
+
+
+def explainQuery(engine, statement, parameters, executemany):
+    '''
+    Return the query plan of [statement] on [engine] as text lines
+    '''
+    dialect = engine.dialect.name
+    if dialect == 'sqlite':
+        explain = 'EXPLAIN QUERY PLAN '
+    elif dialect == 'postgresql':
+        explain = 'EXPLAIN '
+    else:
+        return ['(no query plan for %s)' % dialect]
+    if executemany:
+        parameters = parameters[0] if parameters else ()
+
+    # never on the connection that ran the statement: sqlite3 commits the
+    # open transaction before an EXPLAIN, and a failed EXPLAIN aborts the
+    # transaction on PostgreSQL
+    try:
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(explain + statement, parameters)
+                # the last column holds the plan text for both databases
+                return [unicode(row[-1]) for row in cursor.fetchall()]
+            finally:
+                cursor.close()
+        finally:
+            connection.close()
+    except Exception as e:
+        return ['(query plan unavailable: %s)' % e]
+
+
+def explainSlowQueries(slow_queries, logger):
+    '''
+    Log the queries of the queue [slow_queries] with their query plan, one
+    by one
+    '''
+    while True:
+        engine, statement, parameters, executemany, message = \
+            slow_queries.get()
+        try:
+            logger.warning('%s\nQuery plan:\n  %s', message, '\n  '.join(
+                explainQuery(engine, statement, parameters, executemany)))
+        finally:
+            slow_queries.task_done()
+
+
+def logSlowQueries(engines, threshold, path, max_bytes=10 * 1024 * 1024,
+                   backup_count=5, queue_size=1000):
+    '''
+    Log the queries run on any of [engines] that take longer than
+    [threshold] seconds, with their parameters, route, duration and query
+    plan, to the rotating log file [path].  The plans are read on a
+    background thread from at most [queue_size] waiting queries; return
+    that queue.
+    '''
+    logger = logging.getLogger('catalog.slowquery')
+    logger.setLevel(logging.WARNING)
+    logger.propagate = False
+    handler = logging.handlers.RotatingFileHandler(
+        path, maxBytes=max_bytes, backupCount=backup_count)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    logger.addHandler(handler)
+
+    slow_queries = Queue.Queue(queue_size)
+    thread = threading.Thread(
+        target=explainSlowQueries, args=(slow_queries, logger),
+        name='slow-query-log')
+    thread.daemon = True
+    thread.start()
+
+    for engine in engines:
+        logEngineSlowQueries(engine, threshold, logger, slow_queries)
+    return slow_queries
+
+
+def logEngineSlowQueries(engine, threshold, logger, slow_queries):
+    '''
+    Queue the queries run on [engine] slower than [threshold] seconds on
+    [slow_queries] to be logged to [logger]
+    '''
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def startSlowQueryTimer(conn, cursor, statement, parameters, context,
+                            executemany):
+        conn.info.setdefault('slow_query_start', []).append(time.time())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def logSlowQuery(conn, cursor, statement, parameters, context,
+                     executemany):
+        elapsed = time.time() - conn.info['slow_query_start'].pop()
+        if elapsed < threshold:
+            return
+
+        if has_request_context():
+            route = '%s %s (%s)' % (
+                request.method, request.path, request.endpoint)
+        else:
+            route = 'thread %s' % threading.current_thread().name
+
+        message = 'Slow query: %.1f ms on %s in %s\n%s\nParameters: %r' % (
+            elapsed * 1000, repr(engine.url), route, statement, parameters)
+        try:
+            slow_queries.put_nowait(
+                (engine, statement, parameters, executemany, message))
+        except Queue.Full:
+            logger.warning(
+                '%s\nQuery plan:\n  (skipped, too many slow queries)',
+                message)
+
+    @event.listens_for(engine, 'handle_error')
+    def dropSlowQueryTimer(context):
+        conn = context.connection
+        if conn is not None and conn.info.get('slow_query_start'):
+            conn.info['slow_query_start'].pop()
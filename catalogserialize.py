@@ -0,0 +1,139 @@
+import os
+from flask import current_app, json, request
+
+'''
+Serializers of the catalog's JSON endpoints.
+
+Every endpoint builds its payload from plain values only - strings, integers,
+booleans, None, lists and dictionaries, with dates already formatted the way
+jsonify() formats them - so that any serializer can encode it without a
+Python callback per value.  The client picks the format with its Accept
+header: MessagePack when it asks for application/msgpack and the msgpack
+package is installed, JSON otherwise.  JSON is encoded by ujson when it is
+installed, and by the standard library encoder when it is not or when
+CATALOG_FAST_JSON=0; both give the same bytes as jsonify().
+'''
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+fast_json = ujson is not None \
+    and os.environ.get('CATALOG_FAST_JSON', '1') == '1'
+
+days = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+months = (None, 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug',
+          'Sep', 'Oct', 'Nov', 'Dec')
+
+
+def httpDate(value):
+    '''
+    Return the datetime [value] as the HTTP date string jsonify() writes for
+    it, or None
+    '''
+    if value is None:
+        return None
+    if value.tzinfo is not None:
+        value = (value - value.utcoffset()).replace(tzinfo=None)
+    return '%s, %02d %s %04d %02d:%02d:%02d GMT' % (
+        days[value.weekday()], value.day, months[value.month], value.year,
+        value.hour, value.minute, value.second)
+
+
+def plainItem(item):
+    '''
+    Return Item.serialize of [item] with plain values only
+    '''
+    values = item.serialize
+    values['created'] = httpDate(values['created'])
+    return values
+
+
+def jsonFormat():
+    '''
+    Return the indent and separators jsonify() uses in the current app
+    '''
+    if current_app.config['JSONIFY_PRETTYPRINT_REGULAR'] \
+            or current_app.debug:
+        return 2, (', ', ': ')
+    return None, (',', ':')
+
+
+class JsonSerializer(object):
+    '''
+    Encode payloads exactly as jsonify() does
+    '''
+    name = 'json'
+
+    @property
+    def mimetype(self):
+        return current_app.config['JSONIFY_MIMETYPE']
+
+    def dumps(self, payload):
+        '''
+        Return [payload] encoded as bytes
+        '''
+        indent, separators = jsonFormat()
+        if fast_json and indent is None \
+                and current_app.config['JSON_AS_ASCII']:
+            body = ujson.dumps(
+                payload, ensure_ascii=True, escape_forward_slashes=False,
+                sort_keys=current_app.config['JSON_SORT_KEYS'])
+            # ujson leaves DEL unescaped; in ASCII output it can only
+            # appear inside a string
+            body = body.replace('\x7f', '\\u007f')
+        else:
+            body = json.dumps(payload, indent=indent, separators=separators)
+        body += '\n'
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        return body
+
+
+class MsgpackSerializer(object):
+    '''
+    Encode payloads in the MessagePack binary format
+    '''
+    name = 'msgpack'
+    mimetype = 'application/msgpack'
+
+    def dumps(self, payload):
+        '''
+        Return [payload] encoded as bytes
+        '''
+        # payloads hold no binary data, so byte strings are packed as text
+        return msgpack.packb(payload, use_bin_type=False)
+
+
+json_serializer = JsonSerializer()
+msgpack_serializer = MsgpackSerializer() if msgpack is not None else None
+
+
+def chooseSerializer():
+    '''
+    Return the serializer the current request asks for, JSON by default
+    '''
+    if msgpack_serializer is not None:
+        best = request.accept_mimetypes.best_match(
+            ['application/json', 'application/msgpack',
+             'application/x-msgpack'])
+        if best in ('application/msgpack', 'application/x-msgpack'):
+            return msgpack_serializer
+    return json_serializer
+
+
+def serializedResponse(payload, serializer=None):
+    '''
+    Return a response holding [payload] in the format the request asks for
+    '''
+    serializer = serializer or chooseSerializer()
+    response = current_app.response_class(
+        serializer.dumps(payload), mimetype=serializer.mimetype)
+    response.vary.add('Accept')
+    return response
@@ -0,0 +1,114 @@
+import hashlib
+import mimetypes
+import os
+from flask import request
+from catalogcompress import compressBody, compress_min_bytes, encodings
+from catalogcompress import compressible_mimetypes
+
+'''
+Fingerprinted static files of the catalog application.
+
+At startup every file under the static folder is read once and given a name
+with a hash of its content, such as catalog.3f2a9c1d0b.css.  url_for('static')
+links to the hashed names, which are served from memory with far-future
+cache headers and, where it pays off, in precompressed copies.  A changed
+file gets a new name, so browsers never need to revalidate the old one.
+'''
+
+
+class StaticAssets(object):
+    '''
+    The files under [folder], by their hashed names, each cached for
+    [max_age] seconds
+    '''
+
+    def __init__(self, folder, max_age):
+        self.folder = folder
+        self.max_age = max_age
+        self.hashed = {}
+        self.files = {}
+        self.load()
+
+    def load(self):
+        '''
+        Read, hash and compress every file under the folder
+        '''
+        for root, dirs, names in os.walk(self.folder):
+            for name in names:
+                path = os.path.join(root, name)
+                filename = os.path.relpath(path, self.folder).replace(
+                    os.sep, '/')
+                with open(path, 'rb') as f:
+                    body = f.read()
+
+                digest = hashlib.md5(body).hexdigest()[:10]
+                base, ext = os.path.splitext(filename)
+                hashed = '%s.%s%s' % (base, digest, ext)
+                mimetype = mimetypes.guess_type(filename)[0] \
+                    or 'application/octet-stream'
+
+                # keep a compressed copy only when it is smaller
+                compressed = {}
+                if len(body) >= compress_min_bytes and (
+                        mimetype.startswith('text/')
+                        or mimetype in compressible_mimetypes):
+                    for encoding in encodings:
+                        data = compressBody(body, encoding)
+                        if len(data) < len(body):
+                            compressed[encoding] = data
+
+                self.hashed[filename] = hashed
+                self.files[hashed] = (body, mimetype, digest, compressed)
+
+    def url(self, filename):
+        '''
+        Return the hashed name of [filename], or [filename] if it has none
+        '''
+        return self.hashed.get(filename, filename)
+
+    def response(self, app, filename):
+        '''
+        Return the response serving the hashed file [filename], or None if
+        there is no such file
+        '''
+        entry = self.files.get(filename)
+        if entry is None:
+            return None
+        body, mimetype, digest, compressed = entry
+
+        encoding = request.accept_encodings.best_match(
+            [encoding for encoding in encodings if encoding in compressed])
+        response = app.response_class(
+            compressed[encoding] if encoding else body, mimetype=mimetype)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        response.set_etag(digest, weak=bool(encoding))
+        response.cache_control.public = True
+        response.cache_control.max_age = self.max_age
+        response.cache_control.immutable = True
+        return response.make_conditional(request)
+
+
+def fingerprintStatic(app, max_age=365 * 24 * 3600):
+    '''
+    Serve the static files of [app] under hashed names and make
+    url_for('static') link to them; return the StaticAssets
+    '''
+    assets = StaticAssets(app.static_folder, max_age)
+    send_static_file = app.view_functions['static']
+
+    @app.url_defaults
+    def hashedStaticUrl(endpoint, values):
+        if endpoint == 'static' and 'filename' in values:
+            values['filename'] = assets.url(values['filename'])
+
+    def serveStatic(filename):
+        # files requested by their plain names are served as before
+        response = assets.response(app, filename)
+        if response is None:
+            return send_static_file(filename=filename)
+        return response
+
+    app.view_functions['static'] = serveStatic
+    return assets
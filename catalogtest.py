@@ -3,9 +3,10 @@ import contextlib
 import json
 import datetime
 import time
-from sqlalchemy import create_engine, MetaData
+from sqlalchemy import MetaData
 from sqlalchemy.orm import sessionmaker
-from database_setup import Category, Base, Item, User
+from database_setup import Category, Base, Item, User, bumpCatalogVersion
+from database_setup import CATEGORIES_VERSION, createCatalogEngine
 
 '''
 '''
@@ -15,8 +16,7 @@ app = Flask(__name__)
 Bind the engine to the metadata of the Base class so that
 the declaratives can be accessed through a DBSession instance
 '''
-dburl = 'sqlite:///catalogwithusers.db'
-engine = create_engine(dburl)
+engine = createCatalogEngine()
 
 
 '''
@@ -39,6 +39,8 @@ def emptydb(session):
         session.query(Item).delete()
         session.query(Category).delete()
         session.query(User).delete()
+        bumpCatalogVersion(session)
+        bumpCatalogVersion(session, CATEGORIES_VERSION)
         session.commit()
         print "Emptying database"
     except SQLAlchemyError:
@@ -51,6 +53,8 @@ def createCategory(name, user_id):
     '''
     category = Category(name=name, user_id=user_id)
     session.add(category)
+    bumpCatalogVersion(session)
+    bumpCatalogVersion(session, CATEGORIES_VERSION)
     session.commit()
     return category
 
@@ -63,6 +67,7 @@ def createItem(name, description, category_id, user_id):
         name=name, description=description,
         category_id=category_id, user_id=user_id)
     session.add(item)
+    bumpCatalogVersion(session)
     session.commit()
 
     print "Item %s Added" % name
@@ -79,6 +84,7 @@ def editItem(name, description, item_id, category_id):
     item.name = name
     item.description = description
     session.add(item)
+    bumpCatalogVersion(session)
     session.commit()
     return item
 
@@ -91,6 +97,7 @@ def deleteItem(item_id, category_id):
     item = session.query(Item).filter_by(
         id=item_id, category_id=category_id, user_id=user.id).one()
     session.delete(item)
+    bumpCatalogVersion(session)
     session.commit()
     return True
 
@@ -2,10 +2,14 @@ import os
 import sys
 import datetime
 import time
+import warnings
 from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, func
+from sqlalchemy import Boolean, false
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, event, exc, select
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import CreateColumn
 
 Base = declarative_base()
 
@@ -17,7 +21,7 @@ class User(Base):
     __tablename__ = 'user'
     id = Column(Integer, primary_key=True)
     name = Column(String(250), nullable=False)
-    email = Column(String(250), nullable=False)
+    email = Column(String(250), nullable=False, index=True)
     picture = Column(String(250))
 
 
@@ -28,11 +32,16 @@ class Category(Base):
     __tablename__ = 'category'
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(250), nullable=False)
+    name = Column(String(250), nullable=False, index=True)
     user_id = Column(Integer, ForeignKey('user.id'))
     user = relationship(User)
     items = relationship("Item")
 
+    # a deleted category is hidden while its items are purged in the
+    # background, and removed once they are all gone
+    deleted = Column(
+        Boolean, nullable=False, default=False, server_default=false())
+
     @property
     def serialize(self):
         """Return object data in easily serializeable format"""
@@ -52,8 +61,9 @@ class Item(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String(80), nullable=False)
     description = Column(String(250))
-    created = Column(DateTime, server_default=func.now(), nullable=True)
-    category_id = Column(Integer, ForeignKey('category.id'))
+    created = Column(
+        DateTime, server_default=func.now(), nullable=True, index=True)
+    category_id = Column(Integer, ForeignKey('category.id'), index=True)
     category = relationship(Category)
     user_id = Column(Integer, ForeignKey('user.id'))
     user = relationship(User)
@@ -71,6 +81,273 @@ class Item(Base):
         }
 
 
-engine = create_engine('sqlite:///catalogwithusers.db')
+class CatalogVersion(Base):
+    '''
+    These are counters bumped by changes to the catalog, so that cached
+    copies of catalog data can tell when they are out of date.  The row with
+    id CATALOG_VERSION changes with every category or item, the row with id
+    CATEGORIES_VERSION only when the list of categories changes.
+    '''
+    __tablename__ = 'catalog_version'
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+CATALOG_VERSION = 1
+CATEGORIES_VERSION = 2
+
+
+def getCatalogVersion(session, version_id=CATALOG_VERSION):
+    '''
+    Return the current catalog version, 0 if the catalog was never changed
+    '''
+    version = session.query(CatalogVersion.version).filter_by(
+        id=version_id).scalar()
+    return version or 0
+
+
+def bumpCatalogVersion(session, version_id=CATALOG_VERSION):
+    '''
+    Increment the catalog version as part of the session's current
+    transaction; call this before committing a change to the catalog
+    '''
+    # the rows are created by createSchema(), so that concurrent first
+    # writes never race to insert them
+    updated = session.query(CatalogVersion).filter_by(id=version_id).update(
+        {CatalogVersion.version: CatalogVersion.version + 1},
+        synchronize_session=False)
+    if not updated:
+        raise RuntimeError(
+            'Catalog version %d missing, run database_setup.py' % version_id)
+
+
+def createVersionRows(engine):
+    '''
+    Create the catalog version rows a database does not have yet
+    '''
+    with engine.begin() as conn:
+        existing = set(
+            row[0] for row in conn.execute(select([CatalogVersion.id])))
+        for version_id in (CATALOG_VERSION, CATEGORIES_VERSION):
+            if version_id not in existing:
+                conn.execute(CatalogVersion.__table__.insert().values(
+                    id=version_id, version=0))
+
+
+def createMissingColumns(engine):
+    '''
+    Add the columns declared on the models to the tables of an existing
+    database that was created before they were declared
+    '''
+    inspector = inspect(engine)
+    created = []
+    for table in Base.metadata.sorted_tables:
+        existing = set(
+            column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                # quoted, as user is a reserved word on PostgreSQL
+                engine.execute('ALTER TABLE %s ADD COLUMN %s' % (
+                    engine.dialect.identifier_preparer.format_table(table),
+                    CreateColumn(column).compile(engine)))
+                created.append('%s.%s' % (table.name, column.name))
+    return created
+
+
+def createMissingIndexes(engine):
+    '''
+    Add the indexes declared on the models to the tables of an existing
+    database that was created before they were declared
+    '''
+    inspector = inspect(engine)
+    created = []
+    for table in Base.metadata.sorted_tables:
+        with warnings.catch_warnings():
+            # the PostgreSQL search index is an expression index, which
+            # reflection skips; createSearchIndex() looks after it
+            warnings.filterwarnings(
+                'ignore', 'Skipped unsupported reflection of expression')
+            existing = set(
+                index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=engine)
+                created.append(index.name)
+    return created
+
+
+'''
+Item names and descriptions are indexed for full-text search by the SQLite
+FTS5 table item_fts, which triggers on the item table keep in step with
+every insert, update and delete of an item.
+'''
+search_index_ddl = [
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS item_fts USING fts5(
+        name, description, content='item', content_rowid='id')''',
+    '''CREATE TRIGGER IF NOT EXISTS item_fts_insert AFTER INSERT ON item
+    BEGIN
+        INSERT INTO item_fts(rowid, name, description)
+        VALUES (new.id, new.name, new.description);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS item_fts_delete AFTER DELETE ON item
+    BEGIN
+        INSERT INTO item_fts(item_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS item_fts_update
+    AFTER UPDATE OF name, description ON item
+    BEGIN
+        INSERT INTO item_fts(item_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO item_fts(rowid, name, description)
+        VALUES (new.id, new.name, new.description);
+    END''',
+]
+
+
+'''
+On PostgreSQL the same search runs on a GIN expression index of the text
+search vector of the item name and description.
+'''
+def postgresqlSearchVector(table=''):
+    '''
+    Return the text search vector expression of the item name and
+    description, with the columns prefixed by [table] if it is given
+    '''
+    prefix = table + '.' if table else ''
+    return "to_tsvector('english', coalesce(%sname, '') || ' ' || " \
+        "coalesce(%sdescription, ''))" % (prefix, prefix)
+
+
+def createSearchIndex(engine):
+    '''
+    Create the full-text search index of the items, filling it from the
+    existing items the first time; return True if it was created
+    '''
+    if engine.dialect.name == 'postgresql':
+        with engine.begin() as connection:
+            # reflection skips expression indexes, so ask the catalog
+            if connection.execute(
+                    "SELECT 1 FROM pg_indexes WHERE schemaname = "
+                    "current_schema() AND indexname = 'ix_item_search'"
+                    ).scalar():
+                return False
+            connection.execute(
+                'CREATE INDEX ix_item_search ON item USING gin (%s)'
+                % postgresqlSearchVector())
+        return True
+    if engine.dialect.name != 'sqlite':
+        return False
+    with engine.begin() as connection:
+        if 'item_fts' in inspect(connection).get_table_names():
+            return False
+        for statement in search_index_ddl:
+            connection.execute(statement)
+        connection.execute("INSERT INTO item_fts(item_fts) VALUES ('rebuild')")
+    return True
+
+
+'''
+The database is chosen with the CATALOG_DATABASE_URL environment variable,
+an SQLAlchemy database URL such as postgresql://user@host/catalog, and is
+the SQLite file catalogwithusers.db by default.
+'''
+dburl = os.environ.get('CATALOG_DATABASE_URL', 'sqlite:///catalogwithusers.db')
+
+
+'''
+Every SQLite connection is set up so that readers do not wait for writers:
+the journal is a write-ahead log, a writer waits CATALOG_SQLITE_BUSY_TIMEOUT
+milliseconds for a lock before failing with "database is locked", commits
+are synced less often, and up to CATALOG_SQLITE_MMAP_SIZE bytes of the file
+are read through memory-mapped I/O.
+'''
+sqlite_pragmas = [
+    ('journal_mode', os.environ.get('CATALOG_SQLITE_JOURNAL_MODE', 'WAL')),
+    ('busy_timeout', int(
+        os.environ.get('CATALOG_SQLITE_BUSY_TIMEOUT', 5000))),
+    ('synchronous', os.environ.get('CATALOG_SQLITE_SYNCHRONOUS', 'NORMAL')),
+    ('mmap_size', int(
+        os.environ.get('CATALOG_SQLITE_MMAP_SIZE', 256 * 1024 * 1024))),
+]
+
+
+def setSqlitePragmas(dbapi_connection, connection_record):
+    '''
+    Apply sqlite_pragmas to a new SQLite connection
+    '''
+    cursor = dbapi_connection.cursor()
+    for name, value in sqlite_pragmas:
+        cursor.execute('PRAGMA %s = %s' % (name, value))
+    cursor.close()
+
+
+def createCatalogEngine(url=dburl):
+    '''
+    Create the engine of the catalog database [url].  Connections are kept
+    in a pool sized by the CATALOG_DB_POOL_SIZE, CATALOG_DB_MAX_OVERFLOW,
+    CATALOG_DB_POOL_TIMEOUT and CATALOG_DB_POOL_RECYCLE environment
+    variables, so that concurrent requests each borrow their own connection.
+    '''
+    options = {
+        'pool_size': int(os.environ.get('CATALOG_DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('CATALOG_DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': int(os.environ.get('CATALOG_DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('CATALOG_DB_POOL_RECYCLE', -1)),
+    }
+    if url.startswith('sqlite'):
+        # an in-memory database lives and dies with its single connection
+        if url in ('sqlite://', 'sqlite:///:memory:'):
+            engine = create_engine(url)
+            event.listen(engine, 'connect', setSqlitePragmas)
+            return engine
+        engine = create_engine(
+            url, poolclass=QueuePool,
+            connect_args={'check_same_thread': False}, **options)
+        event.listen(engine, 'connect', setSqlitePragmas)
+    else:
+        engine = create_engine(url, **options)
+    protectPoolAfterFork(engine)
+    return engine
+
+
+def protectPoolAfterFork(engine):
+    '''
+    Keep a process forked from the one that created [engine] from using the
+    pooled connections it inherited: they are dropped, without closing them
+    under the parent's feet, and replaced by new ones
+    '''
+
+    @event.listens_for(engine, 'connect')
+    def rememberConnectionProcess(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, 'checkout')
+    def checkConnectionProcess(dbapi_connection, connection_record,
+                               connection_proxy):
+        pid = os.getpid()
+        if connection_record.info['pid'] != pid:
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError(
+                'Connection record belongs to pid %s, attempting to check '
+                'out in pid %s' % (connection_record.info['pid'], pid))
+
+
+def createSchema(engine):
+    '''
+    Create the tables, version rows and search index of the catalog
+    database, and add the columns and indexes an existing database does not
+    have yet; return the names of the columns and indexes added
+    '''
+    Base.metadata.create_all(engine)
+    created = createMissingColumns(engine) + createMissingIndexes(engine)
+    createVersionRows(engine)
+    createSearchIndex(engine)
+    return created
+
 
-Base.metadata.create_all(engine)
+if __name__ == '__main__':
+    # create the database, or bring an existing one up to date
+    for name in createSchema(createCatalogEngine()):
+        print "Created %s" % name
@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+import unittest
+from sqlalchemy.orm import sessionmaker
+from database_setup import Category, Item, User
+from database_setup import createCatalogEngine, createSchema
+from catalogmetrics import logSlowQueries
+
+'''
+Tests of the slow query log of the catalog application
+
+    python2 -m unittest discover -p 'test_*.py'
+'''
+
+
+class SlowQueryLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = createCatalogEngine(
+            'sqlite:///' + os.path.join(self.directory, 'catalog.db'))
+        createSchema(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+
+        user = User(name='Admin', email='admin@catalog.py')
+        category = Category(name='Hats', user=user)
+        self.session.add_all([user, category] + [
+            Item(name='Hat %d' % index, category=category, user=user)
+            for index in range(100)])
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def testRollbackAfterSlowWrite(self):
+        path = os.path.join(self.directory, 'slow_queries.log')
+        # a threshold of 0 logs every query as slow
+        slow_queries = logSlowQueries([self.engine], 0, path)
+
+        self.session.query(Item).delete()
+        slow_queries.join()
+        self.session.rollback()
+
+        self.assertEqual(self.session.query(Item).count(), 100)
+        with open(path) as f:
+            log = f.read()
+        self.assertIn('DELETE FROM item', log)
+        self.assertIn('Query plan:', log)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import datetime
+import unittest
+from flask import Flask, jsonify
+import catalogserialize
+from catalogserialize import json_serializer, httpDate
+
+'''
+Tests of the serializers of the catalog's JSON endpoints
+
+    python2 -m unittest discover -p 'test_*.py'
+'''
+
+awkward_strings = [
+    u'\x7f', u'DEL\x7f in text', u'\x00\x01\x08\t\n\x0c\r\x1f',
+    u'\x80\x9f\xa0', u'caf\xe9', u'\u2028\u2029', u'\ufeff',
+    u'\U0001f600', u'\ud83d', u'\ude00 lone', u'/', u'</script>',
+    u'"quoted" \\ back\\slash', 'caf\xc3\xa9 bytes', u'']
+
+
+class JsonSerializerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+    def assertSameAsJsonify(self, payload):
+        with self.app.app_context():
+            self.assertEqual(
+                json_serializer.dumps(payload), jsonify(payload).get_data())
+
+    def testAwkwardStrings(self):
+        fast_json = catalogserialize.fast_json
+        try:
+            # with ujson when it is installed, then with the stdlib encoder
+            for catalogserialize.fast_json in (fast_json, False):
+                for string in awkward_strings:
+                    self.assertSameAsJsonify(
+                        {'name': string, string: [string]})
+                self.assertSameAsJsonify({'names': awkward_strings})
+        finally:
+            catalogserialize.fast_json = fast_json
+
+    def testPlainValues(self):
+        created = datetime.datetime(2019, 3, 11, 4, 21, 25)
+        self.assertSameAsJsonify({
+            'id': 1, 'price': None, 'deleted': False, 'ids': [3, 2, 1],
+            'created': httpDate(created)})
+        with self.app.app_context():
+            self.assertEqual(
+                httpDate(created), jsonify(created).get_data()[1:-2])
+
+
+if __name__ == '__main__':
+    unittest.main()